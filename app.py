@@ -2,19 +2,22 @@
 Data Visualization and Dashboarding Steps - Divvy bike trips data
 """
 
-# import numpy as np
+import os
 from math import pi
 
+import numpy as np
+
 import streamlit as st
 
 import pandas as pd
-from bokeh.plotting import figure
-from bokeh.models import FactorRange, ColumnDataSource, HoverTool, NumeralTickFormatter, ColorBar,\
-                    LinearColorMapper, Range1d, FixedTicker
-from bokeh.transform import transform, cumsum
-from bokeh.palettes import viridis
 
-import pydeck as pdk
+# NOTE: bokeh and pydeck are only imported by the functions that build the charts, so the
+#  app starts faster and a report only imports the libraries of its own charts
+
+from divvy import ARTIFACTS_DIR, CUBE_AXES, MANIFEST_FILE, METERS_PER_DEGREE, POINT_LEVELS, \
+                  add_station_locations, build_trip_tables, filter_cube, flow_station_counts, \
+                  has_artifact, load_arrays, load_cube, load_table, point_cell_counts, \
+                  read_bicycle_stations, read_manifest, select_flows, station_name_count
 
 # CSS to fix the PyDeck map layout on mobile
 CSS = """
@@ -30,41 +33,258 @@ CSS = """
 st.markdown(CSS, unsafe_allow_html=True)
 
 ### Import Data
-station_name_count_member_w_location = pd.read_pickle('station_name_count_member_w_location.pkl')
-station_name_count_casual_w_location = pd.read_pickle('station_name_count_casual_w_location.pkl')
-popular_month_count_member = pd.read_pickle('popular_month_count_member.pkl')
-popular_month_count_casual = pd.read_pickle('popular_month_count_casual.pkl')
-day_of_week_count = pd.read_pickle('day_of_week_count.pkl')
-ride_length_avg = pd.read_pickle('ride_length_avg.pkl')
-popular_hours_count = pd.read_pickle('popular_hours_count.pkl')
-rideable_type_count_member = pd.read_pickle('rideable_type_count_member.pkl')
-rideable_type_count_casual = pd.read_pickle('rideable_type_count_casual.pkl')
+# Streamlit runs this whole script again for every click of every user, so let's load
+#  every file only once. The modification time of a file is part of the cache key, so a
+#  file is loaded again after divvy.py rewrites it. The cached objects are shared by all
+#  the users, so nothing below may change them in place
+def file_version(path):
+    """function to get the modification time of a file, or None if it doesn't exist"""
+    return os.path.getmtime(path) if os.path.exists(path) else None
 
 
-### Define Plots
-def viz_popular_month_count_member(sizing_mode="fixed"):
-    """function for popular_month_count_member visualization"""
-    days_labels = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+@st.cache_resource(max_entries=16)
+def load_pickle(path, version):
+    """function to load a Pickle file once for every version of the file"""
+    return pd.read_pickle(path)
+
+
+## Artifacts - divvy.py writes its outputs to divvy_artifacts/ and writes the manifest last,
+#  so the modification time of the manifest is the version of all the artifacts. The arrays
+#  are memory-mapped read-only, so the app only reads the parts of them a chart needs
+@st.cache_resource(max_entries=2)
+def load_manifest(version):
+    """function to read the artifacts manifest once for every version of the file"""
+    return read_manifest() if version is not None else None
+
+
+@st.cache_resource(max_entries=2)
+def load_trip_cube(version):
+    """function to memory-map the trip cube once for every version of the artifacts"""
+    return load_cube(load_manifest(version))
+
+
+@st.cache_resource(max_entries=2)
+def load_trip_flows(version):
+    """function to memory-map the trip flows once for every version of the artifacts"""
+    return load_arrays('trip_flows', load_manifest(version))
+
+
+@st.cache_resource(max_entries=2)
+def load_trip_points(version):
+    """function to memory-map the trip point grids once for every version of the artifacts"""
+    return load_arrays('trip_points', load_manifest(version))
+
+
+@st.cache_resource(max_entries=16)
+def load_artifact_table(name, version):
+    """function to load an Arrow table of the artifacts once for every version of them"""
+    return load_table(name, load_manifest(version))
+
+
+@st.cache_resource(max_entries=2)
+def load_bicycle_stations(path, version):
+    """function to load the station locations once for every version of the file"""
+    return read_bicycle_stations(path)
+
+
+# The station locations, for the station maps of the trip flows
+STATIONS_PATH = 'divvy_bicycle_stations.csv'
+
+# The station maps are sums over the station-to-station trip flows made by divvy.py (see
+#  flow_arrays in divvy.py). The flows are too big for the repo, so without them the
+#  station maps use the station tables of the artifacts (or the Pickle files) and the
+#  Popular Routes report is skipped
+STATION_TABLES = {
+    'station_name_count_member_w_location': 'member',
+    'station_name_count_casual_w_location': 'casual',
+}
+
+
+## Filtered Tables - every selection of the sidebar filters is only computed once as well.
+#  The trip cube and flows are loaded the first time a report needs them, the version of
+#  the artifacts is part of the cache key
+@st.cache_resource(max_entries=64)
+def filtered_trip_tables(version, selection):
+    """function to build the trip tables for the selected labels of the trip cube"""
+    filtered_cube = filter_cube(load_trip_cube(version), **selection)
+
+    return build_trip_tables(filtered_cube) if filtered_cube['trips'].sum() > 0 else None
+
+
+@st.cache_resource(max_entries=64)
+def filtered_station_tables(version, stations_version, selection):
+    """function to build the station tables, with station locations, for the selected buckets"""
+    divvy_bicycle_stations = load_bicycle_stations(STATIONS_PATH, stations_version)
+    station_counts = flow_station_counts(load_trip_flows(version), **selection)
+
+    return {member_type: add_station_locations(station_name_count(station_counts, member_type), \
+                                               divvy_bicycle_stations) \
+            for member_type in ['member', 'casual']}
+
+
+@st.cache_resource(max_entries=64)
+def filtered_top_flows(version, top, selection):
+    """function to get the most popular routes for the selected buckets"""
+    return top_flows(load_trip_flows(version), top=top, **selection)
+
+
+@st.cache_resource(max_entries=64)
+def filtered_point_cells(version, level, selection):
+    """function to list the cells of a point grid level with trips, for the selected labels"""
+    return point_cell_counts(load_trip_points(version), level, **selection)
+
+
+## Sidebar filters - every chart is rebuilt from the trip cube (and the station maps from
+#  the trip flows) for the selected months, bike types, and hours
+artifacts_version = file_version(os.path.join(ARTIFACTS_DIR, MANIFEST_FILE))
+artifacts_manifest = load_manifest(artifacts_version)
+has_trip_cube = artifacts_manifest is not None and has_artifact('trip_cube', artifacts_manifest)
+has_trip_flows = artifacts_manifest is not None and has_artifact('trip_flows', artifacts_manifest)
+has_trip_points = artifacts_manifest is not None \
+                    and has_artifact('trip_points', artifacts_manifest)
+
+st.sidebar.header("Filters")
+if not has_trip_cube:
+    st.sidebar.caption("Run divvy.py to create divvy_artifacts and use the filters.")
 
-    popular_month_count_member_copy = popular_month_count_member.copy()
+first_month, last_month = st.sidebar.slider("Months", min_value=1, max_value=12, value=(1, 12), \
+                                            disabled=not has_trip_cube)
+selected_rideable_types = st.sidebar.multiselect("Bike Types", CUBE_AXES['rideable_type'], \
+                                                 default=CUBE_AXES['rideable_type'], \
+                                    format_func=lambda name: name.replace('_', ' ').title(), \
+                                                 disabled=not has_trip_cube)
+first_hour, last_hour = st.sidebar.slider("Hours", min_value=0, max_value=23, value=(0, 23), \
+                                          disabled=not has_trip_cube)
+
+trip_selection = {
+    'month': tuple(range(first_month, last_month + 1)),
+    'rideable_type': tuple(selected_rideable_types),
+    'hour': tuple(range(first_hour, last_hour + 1)),
+}
+is_filtered = (first_month, last_month) != (1, 12) or (first_hour, last_hour) != (0, 23) \
+                or len(selected_rideable_types) < len(CUBE_AXES['rideable_type'])
+
+
+## Data Registry - nothing is loaded up front. Every report asks for its own tables with
+#  get_table(), and they're only loaded (or built) the first time a report needs them.
+#  Without the artifacts (e.g. right after cloning the repo), the Pickle files are used
+def get_table(name):
+    """function to get one of the report tables by name, for the sidebar filters"""
+    if name in STATION_TABLES:
+        # The station maps can only be filtered with the trip flows, otherwise they show
+        #  the whole year
+        if has_trip_flows:
+            return filtered_station_tables(artifacts_version, file_version(STATIONS_PATH), \
+                                           trip_selection)[STATION_TABLES[name]]
+        if artifacts_manifest is not None and has_artifact(name, artifacts_manifest):
+            return load_artifact_table(name, artifacts_version)
+    elif has_trip_cube:
+        trip_tables = filtered_trip_tables(artifacts_version, trip_selection)
+
+        if trip_tables is None:
+            st.warning("There are no trips for the selected filters.")
+            st.stop()
+
+        return trip_tables[name]
+
+    return load_pickle(f'{name}.pkl', file_version(f'{name}.pkl'))
+
+
+### Prepare Plot Data
+# The tables are cached and shared by all the users, so these functions never change them
+#  in place, they return new data frames for the charts. The labels and colors are looked
+#  up for whole columns at once, not row by row, so they stay fast for more categories.
+#  st.cache_data keeps the prepared data of every table, and hands every run its own copy
+DAYS_LABELS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+@st.cache_data(max_entries=16)
+def prep_popular_month_count(popular_month_count):
+    """function to prepare popular_month_count for the heatmap, with the months as indexes"""
+    months = popular_month_count['month'].astype(int).to_numpy()
+    months_int = np.unique(months)
+
+    heatmap_data = popular_month_count.assign(
+        original_month=popular_month_count['month'],
+        month=np.searchsorted(months_int, months),
+        day_of_week=np.array(DAYS_LABELS, dtype=object)[popular_month_count['day_of_week']],
+    )
+
+    return heatmap_data, months_int.tolist()
+
+
+@st.cache_data(max_entries=16)
+def prep_day_of_week_count(day_of_week_count):
+    """function to prepare the bars of day_of_week_count, grouped by day of week"""
+    from bokeh.palettes import viridis
+
+    ## map day_of_week where Monday is 0 and Sunday is 6
+    days_short = np.array([day[:3] for day in DAYS_LABELS], dtype=object)
+
+    sorted_data = day_of_week_count.sort_values(by=['day_of_week', 'member_casual'])
+
+    # Every member type gets its own color, in the order they first show up
+    codes, member_types = pd.factorize(sorted_data['member_casual'])
+
+    return {
+        'x': list(zip(days_short[sorted_data['day_of_week']], sorted_data['member_casual'])),
+        'top': sorted_data['count'].tolist(),
+        'color': np.array(viridis(len(member_types)), dtype=object)[codes].tolist(),
+    }
+
+
+@st.cache_data(max_entries=16)
+def prep_ride_length_avg(ride_length_avg):
+    """function to prepare ride_length_avg for the bar chart, with a color per member type"""
+    from bokeh.palettes import viridis
+
+    codes, _ = pd.factorize(ride_length_avg['member_casual'])
+
+    return ride_length_avg.assign(color=np.array(viridis(2), dtype=object)[codes])
 
-    months_int = sorted(popular_month_count_member_copy['month'].unique(), key=int)
-    months_str = [str(month) for month in months_int]
 
-    month_to_index = {month: index for index, month in enumerate(months_int)}
+@st.cache_data(max_entries=16)
+def prep_popular_hours_count(popular_hours_count):
+    """function to split popular_hours_count into one table per member type, sorted by hour"""
+    sorted_data = popular_hours_count.sort_values(by='hour', kind='stable')
 
-    popular_month_count_member_copy['original_month'] = popular_month_count_member_copy['month']
-    popular_month_count_member_copy['month'] = popular_month_count_member_copy['month']\
-                                           .astype(int).map(month_to_index)
+    return {member_type: sorted_data[sorted_data['member_casual'] == member_type] \
+            for member_type in ['member', 'casual']}
+
+
+@st.cache_data(max_entries=16)
+def prep_rideable_type_count(rideable_type_count):
+    """function to prepare a rideable_type_count table for the pie chart"""
+    from bokeh.palettes import viridis
+
+    share = rideable_type_count['count'] / rideable_type_count['count'].sum()
+
+    return rideable_type_count.assign(angle=share * 2 * pi, \
+                                      color=viridis(len(rideable_type_count)), \
+                                      percentage=share * 100)
+
+
+### Define Plots
+# A Bokeh figure (and every model in it) belongs to the one document it is rendered in, and
+#  every session renders its own. So the figures are never cached: they are built on every
+#  run from the cached prepared data above, which only takes a few milliseconds
+def viz_popular_month_count_member(popular_month_count_member, sizing_mode="fixed"):
+    """function for popular_month_count_member visualization"""
+    from bokeh.plotting import figure
+    from bokeh.models import ColorBar, LinearColorMapper, Range1d, FixedTicker
+    from bokeh.transform import transform
+    from bokeh.palettes import viridis
+
+    heatmap_data, months_int = prep_popular_month_count(popular_month_count_member)
 
     #set the theme color
     colors = viridis(256)
 
-    mapper = LinearColorMapper(palette=colors, low=popular_month_count_member_copy['count']\
-                                        .min(), high=popular_month_count_member_copy['count'].max())
+    mapper = LinearColorMapper(palette=colors, low=heatmap_data['count'].min(), \
+                               high=heatmap_data['count'].max())
 
     plot_figure = figure(title="Popular Month Count by Day of Week Heatmap - Member",
-               x_range=Range1d(-0.5, len(months_str)-0.5), y_range=days_labels,
+               x_range=Range1d(-0.5, len(months_int)-0.5), y_range=DAYS_LABELS,
                width=900, height=400,
                tools="hover,save,pan,box_zoom,reset,wheel_zoom",
                sizing_mode=sizing_mode, #for mobile responsiveness
@@ -75,11 +295,8 @@ def viz_popular_month_count_member(sizing_mode="fixed"):
     plot_figure.xaxis.ticker = FixedTicker(ticks=list(range(len(months_int))))
     plot_figure.xaxis.major_label_overrides = {i: str(month) for i, month in enumerate(months_int)}
 
-    popular_month_count_member_copy['day_of_week'] = popular_month_count_member_copy['day_of_week']\
-                                                  .map(lambda x: days_labels[x])
-
     plot_figure.rect(x='month', y='day_of_week', width=1, height=1,\
-           source=popular_month_count_member_copy,
+           source=heatmap_data,
            fill_color=transform('count', mapper),
            line_color=None)
 
@@ -89,28 +306,22 @@ def viz_popular_month_count_member(sizing_mode="fixed"):
     return plot_figure
 
 
-def viz_popular_month_count_casual(sizing_mode="fixed"):
+def viz_popular_month_count_casual(popular_month_count_casual, sizing_mode="fixed"):
     """function for popular_month_count_casual visualization"""
-    days_labels = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-
-    popular_month_count_casual_copy = popular_month_count_casual.copy()
-
-    months_int = sorted(popular_month_count_casual_copy['month'].unique(), key=int)
-    months_str = [str(month) for month in months_int]
+    from bokeh.plotting import figure
+    from bokeh.models import ColorBar, LinearColorMapper, Range1d, FixedTicker
+    from bokeh.transform import transform
+    from bokeh.palettes import viridis
 
-    month_to_index = {month: index for index, month in enumerate(months_int)}
-
-    popular_month_count_casual_copy['original_month'] = popular_month_count_casual_copy['month']
-    popular_month_count_casual_copy['month'] = popular_month_count_casual_copy['month']\
-                                            .astype(int).map(month_to_index)
+    heatmap_data, months_int = prep_popular_month_count(popular_month_count_casual)
 
     #set the theme color
     colors = viridis(256)
-    mapper = LinearColorMapper(palette=colors, low=popular_month_count_casual_copy['count']\
-                               .min(), high=popular_month_count_casual_copy['count'].max())
+    mapper = LinearColorMapper(palette=colors, low=heatmap_data['count'].min(), \
+                               high=heatmap_data['count'].max())
 
     plot_figure = figure(title="Popular Month Count by Day of Week Heatmap - Casual",
-               x_range=Range1d(-0.5, len(months_str)-0.5), y_range=days_labels,
+               x_range=Range1d(-0.5, len(months_int)-0.5), y_range=DAYS_LABELS,
                width=900, height=400,
                tools="hover,save,pan,box_zoom,reset,wheel_zoom",
                sizing_mode=sizing_mode, #for mobile responsiveness
@@ -120,11 +331,8 @@ def viz_popular_month_count_casual(sizing_mode="fixed"):
     plot_figure.xaxis.ticker = FixedTicker(ticks=list(range(len(months_int))))
     plot_figure.xaxis.major_label_overrides = {i: str(month) for i, month in enumerate(months_int)}
 
-    popular_month_count_casual_copy['day_of_week'] = popular_month_count_casual_copy['day_of_week']\
-                                                  .map(lambda x: days_labels[x])
-
     plot_figure.rect(x='month', y='day_of_week', width=1, height=1, \
-                     source=popular_month_count_casual_copy,
+                     source=heatmap_data,
            fill_color=transform('count', mapper),
            line_color=None)
 
@@ -135,27 +343,18 @@ def viz_popular_month_count_casual(sizing_mode="fixed"):
 
 
 
-def viz_day_of_week_count(sizing_mode="fixed"):
+def viz_day_of_week_count(day_of_week_count, sizing_mode="fixed"):
     """function for day_of_week_count visualization"""
-    ## map day_of_week where Monday is 0 and Sunday is 6
-    day_mapping = {0: 'Mon', 1: 'Tue', 2: 'Wed', 3: 'Thu', 4: 'Fri', 5: 'Sat', 6: 'Sun'}
-
-    sorted_data = day_of_week_count.sort_values(by=['day_of_week', 'member_casual'])
-
-    x_axis = [(day_mapping[row['day_of_week']], row['member_casual']) \
-              for _, row in sorted_data.iterrows()]
-    counts = list(sorted_data['count'])
+    from bokeh.plotting import figure
+    from bokeh.models import FactorRange, HoverTool, NumeralTickFormatter
 
-    colors = viridis(len(sorted_data['member_casual'].unique()))
-    color_map = {category: color for category, color in zip(sorted_data['member_casual']\
-                                                            .unique(), colors)}
-    colors = [color_map[category] for category in sorted_data['member_casual']]
+    bars = prep_day_of_week_count(day_of_week_count)
 
-    plot_figure = figure(x_range=FactorRange(*x_axis), height=350, title="Day of Week Count",
+    plot_figure = figure(x_range=FactorRange(*bars['x']), height=350, title="Day of Week Count",
                sizing_mode=sizing_mode,
                toolbar_location=None, tools="", x_axis_label="Day of Week", y_axis_label="Count")
 
-    plot_figure.vbar(x=x_axis, top=counts, width=0.9, color=colors)
+    plot_figure.vbar(x=bars['x'], top=bars['top'], width=0.9, color=bars['color'])
 
     hover = HoverTool()
     hover.tooltips = [
@@ -172,12 +371,12 @@ def viz_day_of_week_count(sizing_mode="fixed"):
     return plot_figure
 
 
-def viz_ride_length_avg(sizing_mode="fixed"):
+def viz_ride_length_avg(ride_length_avg, sizing_mode="fixed"):
     """function for ride_length_avg visualization"""
-    colors = viridis(2)
-    color_map = {category: color for category, color in zip(ride_length_avg['member_casual']\
-                                                            .unique(), colors)}
-    ride_length_avg['color'] = ride_length_avg['member_casual'].map(color_map)
+    from bokeh.plotting import figure
+    from bokeh.models import FactorRange, HoverTool, NumeralTickFormatter
+
+    ride_length_avg = prep_ride_length_avg(ride_length_avg)
 
     plot_figure = figure(y_range=FactorRange(*ride_length_avg['member_casual'].unique()), \
                width=400, height=200, sizing_mode=sizing_mode,
@@ -198,15 +397,15 @@ def viz_ride_length_avg(sizing_mode="fixed"):
     return plot_figure
 
 
-def viz_popular_hours_count(sizing_mode="fixed"):
+def viz_popular_hours_count(popular_hours_count, sizing_mode="fixed"):
     """function for popular_hours_count visualization"""
-    # Filtering data for 'member' and 'casual' values
-    member_data = popular_hours_count[popular_hours_count['member_casual'] == 'member']\
-                .sort_values(by='hour')
-    casual_data = popular_hours_count[popular_hours_count['member_casual'] == 'casual']\
-                .sort_values(by='hour')
-    member_source = ColumnDataSource(member_data)
-    casual_source = ColumnDataSource(casual_data)
+    from bokeh.plotting import figure
+    from bokeh.models import ColumnDataSource, HoverTool, NumeralTickFormatter
+
+    # One line for 'member' and one for 'casual'
+    hours_data = prep_popular_hours_count(popular_hours_count)
+    member_source = ColumnDataSource(hours_data['member'])
+    casual_source = ColumnDataSource(hours_data['casual'])
 
     plot_figure = figure(width=600, height=400, title="Popular Hours Count", \
                sizing_mode=sizing_mode, #for mobile responsiveness\
@@ -238,18 +437,13 @@ def viz_popular_hours_count(sizing_mode="fixed"):
     return plot_figure
 
 
-def viz_rideable_type_count_member(sizing_mode="fixed"):
+def viz_rideable_type_count_member(rideable_type_count_member, sizing_mode="fixed"):
     """function for rideable_type_count_member visualization"""
-    rideable_type_count_member_copy = rideable_type_count_member.copy()
-    rideable_type_count_member_copy['angle'] = rideable_type_count_member_copy['count'] \
-                                        / rideable_type_count_member_copy['count'].sum() * 2 * pi
-    rideable_type_count_member_copy['color'] = viridis(len(rideable_type_count_member_copy))
-
-    #Calculate the percentages
-    rideable_type_count_member_copy['percentage'] = rideable_type_count_member_copy['count'] \
-                                        / rideable_type_count_member_copy['count'].sum() * 100
+    from bokeh.plotting import figure
+    from bokeh.models import ColumnDataSource, HoverTool
+    from bokeh.transform import cumsum
 
-    source = ColumnDataSource(rideable_type_count_member_copy)
+    source = ColumnDataSource(prep_rideable_type_count(rideable_type_count_member))
 
     plot_figure = figure(plot_height=255, title="Rideable Type Count (Members)",\
                           toolbar_location=None, x_range=(-0.5, 1.0), sizing_mode=sizing_mode)
@@ -270,18 +464,13 @@ def viz_rideable_type_count_member(sizing_mode="fixed"):
 
     return plot_figure
 
-def viz_rideable_type_count_casual(sizing_mode="fixed"):
+def viz_rideable_type_count_casual(rideable_type_count_casual, sizing_mode="fixed"):
     """function for rideable_type_count_casual visualization"""
-    rideable_type_count_casual_copy = rideable_type_count_casual.copy()
-    rideable_type_count_casual_copy['angle'] = rideable_type_count_casual_copy['count'] \
-                                        / rideable_type_count_casual_copy['count'].sum() * 2 * pi
-    rideable_type_count_casual_copy['color'] = viridis(len(rideable_type_count_casual_copy))
+    from bokeh.plotting import figure
+    from bokeh.models import ColumnDataSource, HoverTool
+    from bokeh.transform import cumsum
 
-    #Calculate the percentages
-    rideable_type_count_casual_copy['percentage'] = rideable_type_count_casual_copy['count'] \
-                                            / rideable_type_count_casual_copy['count'].sum() * 100
-
-    source = ColumnDataSource(rideable_type_count_casual_copy)
+    source = ColumnDataSource(prep_rideable_type_count(rideable_type_count_casual))
 
     plot_figure = figure(plot_height=255, title="Rideable Type Count (Casuals)", \
                          toolbar_location=None, x_range=(-0.5, 1.0), sizing_mode=sizing_mode)
@@ -303,19 +492,43 @@ def viz_rideable_type_count_casual(sizing_mode="fixed"):
     return plot_figure
 
 
-def generate_color_legend(data, num_colors=10):
-    """function to generate color legend for popular stations map"""
-    min_val = data['count_total'].min()
-    max_val = data['count_total'].max()
-    step = (max_val - min_val) / num_colors
-    values = [(min_val + i*step, min_val + (i+1)*step) for i in range(num_colors)]
+## Station Colors - the stations are colored by their count, in num_colors bins of the
+#  same width between the smallest and the largest count. The colors of the bins are looked
+#  up in one RGB table, so the maps and the legends show the same colors
+@st.cache_resource
+def viridis_rgb():
+    """function to get the viridis palette once, as a lookup table of 256 RGB colors"""
+    from bokeh.palettes import viridis
+
+    hex_colors = np.array([int(color[1:], 16) for color in viridis(256)])
+
+    return ((hex_colors[:, None] >> np.array([16, 8, 0])) & 255).astype(np.uint8)
+
+
+def bin_colors(num_colors):
+    """function to get the RGB color of every bin, spread over the whole viridis palette"""
+    return viridis_rgb()[np.arange(num_colors) * 255 // max(num_colors - 1, 1)]
+
+
+def count_bins(counts, num_colors):
+    """function to get the bin of every count with np.digitize, and the edges of the bins"""
+    counts = np.asarray(counts)
+    min_val, max_val = (counts.min(), counts.max()) if len(counts) else (0, 0)
+    edges = min_val + np.arange(num_colors + 1) * ((max_val - min_val) / num_colors)
+
+    # Like pd.cut, the bins include their upper edge, and the first bin its lower edge too
+    return np.digitize(counts, edges[1:-1], right=True), edges
+
+
+def generate_color_legend(data, num_colors=10, column='count_total', title="Station Name Counts"):
+    """function to generate color legend for popular stations map (or trip density map)"""
+    _, edges = count_bins(data[column], num_colors)
+    colors = ['#{:02x}{:02x}{:02x}'.format(*rgb) for rgb in bin_colors(num_colors).tolist()]
 
     # Add the title for the legend
-    st.write("Station Name Counts")
+    st.write(title)
 
-    for lower, upper in values:
-        norm_val = (lower - min_val) / (max_val - min_val)
-        color = viridis(256)[int(norm_val * 255)]
+    for lower, upper, color in zip(edges[:-1], edges[1:], colors):
         st.write(
             f"<div style='display: inline-block; margin-right: 10px;'>"
             f"<div style='background-color: {color}; width: 40px; height: 10px; \
@@ -326,26 +539,23 @@ def generate_color_legend(data, num_colors=10):
         )
 
 
+@st.cache_resource(max_entries=16)
 def viz_pydeck_map(data, num_colors=10):
     """function to generate map for popular stations map using pydeck"""
-    # Compute viridis colors, bin the data into 10 bins, and assign color for each bin
-    min_val = data['count_total'].min()
-    max_val = data['count_total'].max()
-    step = (max_val - min_val) / num_colors
+    import pydeck as pdk
 
-    bins = pd.cut(data['count_total'], bins=[min_val + i*step for i in range(num_colors+1)], \
-                  labels=False, include_lowest=True)
-
-    colors = [viridis(256)[int(i * 255 / (num_colors-1))] for i in bins]
-    data['colors'] = [[int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16)] \
-                      for color in colors]
+    # Bin the data into 10 bins, and look up the viridis color of every bin for all the
+    #  stations at once (in new columns, the cached data frame stays as it is)
+    bins, _ = count_bins(data['count_total'], num_colors)
+    colors = bin_colors(num_colors)[bins]
+    data = data.assign(color_r=colors[:, 0], color_g=colors[:, 1], color_b=colors[:, 2])
 
     layer = pdk.Layer(
         'ScatterplotLayer',
         data,
         get_position='[Longitude, Latitude]',
         get_radius=200,
-        get_fill_color="colors",
+        get_fill_color="[color_r, color_g, color_b]",
         pickable=True,
         opacity=0.8
     )
@@ -367,11 +577,119 @@ def viz_pydeck_map(data, num_colors=10):
     )
 
 
+def top_flows(flows, top=20, **selection):
+    """function to get the most popular station-to-station trips for the selected buckets"""
+    rows = select_flows(flows, **selection)
+
+    # Let's add up the counts of every start and end station pair, over the selected buckets
+    stations = len(flows['stations'])
+    counts = np.bincount(flows['start_station'][rows].astype(np.int64) * stations \
+                         + flows['end_station'][rows], weights=flows['count'][rows], \
+                         minlength=stations * stations)
+
+    # Only the pairs with at least as many trips as the top-th pair need to be sorted
+    #  (ties are sorted by start and end station)
+    top = min(top, len(counts))
+    candidates = np.flatnonzero(counts >= np.partition(counts, -top)[-top]) if top \
+                    else np.array([], dtype=np.int64)
+    candidates = candidates[counts[candidates] > 0]
+    best = candidates[np.argsort(-counts[candidates], kind='stable')][:top]
+
+    return pd.DataFrame({
+        'start_station': flows['stations'][best // stations],
+        'end_station': flows['stations'][best % stations],
+        'count': counts[best].astype(np.int64),
+    })
+
+
+@st.cache_resource(max_entries=16)
+def viz_flow_map(data, divvy_bicycle_stations):
+    """function to generate map for popular routes using pydeck"""
+    import pydeck as pdk
+
+    locations = divvy_bicycle_stations.drop_duplicates(subset='Station Name') \
+                                      .set_index('Station Name')[['Latitude', 'Longitude']]
+
+    data = data.join(locations.add_prefix('start_'), on='start_station') \
+               .join(locations.add_prefix('end_'), on='end_station') \
+               .dropna()
+
+    layer = pdk.Layer(
+        'ArcLayer',
+        data,
+        get_source_position='[start_Longitude, start_Latitude]',
+        get_target_position='[end_Longitude, end_Latitude]',
+        get_width='1 + 9 * count / {}'.format(max(data['count'].max(), 1)),
+        get_source_color=[68, 1, 84],
+        get_target_color=[253, 231, 37],
+        pickable=True
+    )
+
+    view_state = pdk.ViewState(latitude=locations['Latitude'].mean(), \
+                               longitude=locations['Longitude'].mean(), zoom=10, pitch=40)
+
+    return pdk.Deck(
+        layers=[layer],
+        initial_view_state=view_state,
+        map_style="light",
+        tooltip={
+                "html": "<div style='font-size: 13px;'><b>{start_station}</b> to \
+                    <b>{end_station}</b><br>Trip Count: {count}</div>"
+            }
+    )
+
+
+## Trip Density Map - the trips are added up on the point grids made by divvy.py, so the
+#  browser only gets the cells with trips, never the trips themselves. Every zoom level of
+#  the map gets the grid level with cells of a few pixels (the finest one from zoom 13)
+DENSITY_ZOOMS = list(range(8, 16))
+
+
+def density_level(zoom):
+    """function to pick the point grid level for a zoom level of the map"""
+    return min(max(13 - zoom, 0), POINT_LEVELS - 1)
+
+
+@st.cache_resource(max_entries=16)
+def viz_point_grid(data, cell_size, zoom, num_colors=10):
+    """function to generate map for trip density using pydeck"""
+    import pydeck as pdk
+
+    # The cells are colored with the same bins as the stations of the station maps
+    bins, _ = count_bins(data['count'], num_colors)
+    colors = bin_colors(num_colors)[bins]
+    data = data.assign(color_r=colors[:, 0], color_g=colors[:, 1], color_b=colors[:, 2])
+
+    layer = pdk.Layer(
+        'GridCellLayer',
+        data,
+        get_position='[Longitude, Latitude]',
+        cell_size=cell_size,
+        get_fill_color="[color_r, color_g, color_b]",
+        extruded=False,
+        pickable=True,
+        opacity=0.8
+    )
+
+    view_state = pdk.ViewState(latitude=data['Latitude'].mean(), \
+                               longitude=data['Longitude'].mean(), zoom=zoom)
+
+    return pdk.Deck(
+        layers=[layer],
+        initial_view_state=view_state,
+        map_style="light",
+        tooltip={
+                "html": "<div style='font-size: 13px;'>Trip Count: {count}</div>"
+            }
+    )
+
+
 ###Custom Functions for Chart Displays
 def display_popular_hours():
     """function to display the chart viz_popular_hours_count"""
     st.subheader("Popular Hours")
-    st.bokeh_chart(viz_popular_hours_count(sizing_mode="scale_width"))
+    st.bokeh_chart(viz_popular_hours_count(get_table('popular_hours_count'), \
+                                           sizing_mode="scale_width"))
     st.markdown("From the above data visualization, you can see how both casuals and members\
             like to use Divvy bikes between 15-18 (3 PM - 6 PM).\
             However, casuals have higher trip counts later at night.\
@@ -381,7 +699,8 @@ def display_popular_hours():
 def display_popular_days():
     """function to display the chart viz_day_of_week_count"""
     st.subheader("Popular Days")
-    st.bokeh_chart(viz_day_of_week_count(sizing_mode="scale_width"))
+    st.bokeh_chart(viz_day_of_week_count(get_table('day_of_week_count'), \
+                                         sizing_mode="scale_width"))
     st.markdown("Members use Divvy bikes more on weekdays, whereas casuals prefer to use them on \
                 weekends. One theory about this is that casuals use Divvy bikes more for hobbies \
                 and leisure, whereas members are more likely to use the bikes more for work \
@@ -396,10 +715,12 @@ def display_popular_months():
                and 'Member' for members.")
     tab1, tab2 = st.tabs(["Casual", "Member"])
     with tab1:
-        st.bokeh_chart(viz_popular_month_count_casual(sizing_mode="scale_width"))
+        st.bokeh_chart(viz_popular_month_count_casual(get_table('popular_month_count_casual'), \
+                                                      sizing_mode="scale_width"))
 
     with tab2:
-        st.bokeh_chart(viz_popular_month_count_member(sizing_mode="scale_width"))
+        st.bokeh_chart(viz_popular_month_count_member(get_table('popular_month_count_member'), \
+                                                      sizing_mode="scale_width"))
 
     st.markdown("""
     Both heatmaps show\
@@ -421,8 +742,14 @@ def display_popular_months():
 def display_popular_stations():
     """function to display the chart viz_pydeck_map and generate_color_legend"""
     st.subheader("Popular Stations")
+    if is_filtered and not has_trip_flows:
+        st.caption("The station maps show the whole year, run divvy.py to create the trip \
+                   flows and filter them too.")
     st.caption("Switch the tabs below to view different visualizations: 'Casual' for casual users \
                and 'Member' for members.")
+    station_name_count_casual_w_location = get_table('station_name_count_casual_w_location')
+    station_name_count_member_w_location = get_table('station_name_count_member_w_location')
+
     tab1, tab2 = st.tabs(["Casual", "Member"])
     with tab1:
         col1, col2 = st.columns([3, 1])
@@ -455,10 +782,77 @@ def display_popular_stations():
             previous point on how casuals use the bikes for hobbies and leisure. The Navy Pier is \
             a tourist attraction in Chicago.""")
 
+def display_popular_routes():
+    """function to display the top_flows table and viz_flow_map"""
+    st.subheader("Popular Routes")
+
+    if not has_trip_flows:
+        st.info("Run divvy.py to create the trip flows for this report.")
+        return
+
+    col1, col2 = st.columns(2)
+    with col1:
+        rider_type = st.selectbox("Rider Type", ['All', 'Casual', 'Member'])
+    with col2:
+        top = st.slider("Number of Routes", min_value=5, max_value=50, value=20)
+
+    # The months, bike types, and hours come from the sidebar filters
+    member_types = CUBE_AXES['member_casual'] if rider_type == 'All' else [rider_type.lower()]
+    popular_routes = filtered_top_flows(artifacts_version, top, \
+                                        dict(trip_selection, member_casual=tuple(member_types)))
+
+    st.pydeck_chart(viz_flow_map(popular_routes, load_bicycle_stations(\
+                                     STATIONS_PATH, file_version(STATIONS_PATH))))
+    st.dataframe(popular_routes, hide_index=True)
+
+def display_trip_density():
+    """function to display the chart viz_point_grid and generate_color_legend"""
+    st.subheader("Trip Density")
+
+    if not has_trip_points:
+        st.info("Run divvy.py to create the trip points for this report.")
+        return
+
+    if is_filtered:
+        st.caption("The trip density map shows the whole year, the sidebar filters don't apply \
+                   to it.")
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        rider_type = st.selectbox("Rider Type", ['All', 'Casual', 'Member'], \
+                                  key='density_rider_type')
+    with col2:
+        trip_end = st.selectbox("Trip Points", ['Start', 'End', 'Both'])
+    with col3:
+        zoom = st.select_slider("Zoom", options=DENSITY_ZOOMS, value=11)
+
+    member_types = CUBE_AXES['member_casual'] if rider_type == 'All' else [rider_type.lower()]
+    trip_ends = ['start', 'end'] if trip_end == 'Both' else [trip_end.lower()]
+
+    # The cells of level 0 are about 110 meters high, every level doubles them
+    level = density_level(zoom)
+    trip_points = load_trip_points(artifacts_version)
+    point_cells = filtered_point_cells(artifacts_version, level, \
+                                       {'member_casual': tuple(member_types), \
+                                        'end': tuple(trip_ends)})
+
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        st.pydeck_chart(viz_point_grid(point_cells, float(trip_points['step'][0] \
+                                       * METERS_PER_DEGREE * 2 ** level), zoom))
+    with col2:
+        generate_color_legend(point_cells, column='count', title="Trip Counts per Cell")
+
+    st.markdown("""
+    Unlike the station maps, this map counts every trip where it started or ended, including \
+        the electric bikes that were parked away from a station. Those trips don't have a \
+            station name, so the other reports leave them out. Use the zoom slider above to see \
+            more (or less) detail, the cells get smaller as you zoom in.""")
+
 def average_ride_length():
     """function to display the chart viz_ride_length_avg"""
     st.subheader("Average Ride Length (Minutes)")
-    st.bokeh_chart(viz_ride_length_avg(sizing_mode="scale_width"))
+    st.bokeh_chart(viz_ride_length_avg(get_table('ride_length_avg'), sizing_mode="scale_width"))
 
     st.markdown("""
     Average ride lengths from casuals and members differ greatly. Casuals' average ride length in \
@@ -473,8 +867,10 @@ def average_ride_length():
 def bike_types():
     """function to display the viz_rideable_type_count charts"""
     st.subheader("Bike Types")
-    st.bokeh_chart(viz_rideable_type_count_casual(sizing_mode="scale_width"))
-    st.bokeh_chart(viz_rideable_type_count_member(sizing_mode="scale_width"))
+    st.bokeh_chart(viz_rideable_type_count_casual(get_table('rideable_type_count_casual'), \
+                                                  sizing_mode="scale_width"))
+    st.bokeh_chart(viz_rideable_type_count_member(get_table('rideable_type_count_member'), \
+                                                  sizing_mode="scale_width"))
 
     st.markdown("""
     There is a difference between casuals and members when it comes to bike types. Members like \
@@ -492,11 +888,15 @@ def bike_types():
 selection_menu = st.sidebar.radio(
     'Choose a Specific Report:',
     ('All', 'Popular Hours', 'Popular Days', 'Popular Months', 'Popular Stations', \
-     'Average Ride Length', 'Bike Types')
+     'Popular Routes', 'Trip Density', 'Average Ride Length', 'Bike Types')
 )
 
 ## Display selected charts using the custom functions for chart displays, and put
 # additional titles and notes
+if is_filtered:
+    st.info("The charts below only count the trips of the selected filters, but the notes \
+            describe the whole year of 2022.")
+
 if selection_menu == 'All':
     st.title("Divvy Data Analysis Report with Interactive Visualizations")
     st.markdown("*by: Ruddy Setiadi Gunawan*")
@@ -518,6 +918,8 @@ if selection_menu == 'All':
     display_popular_days()
     display_popular_months()
     display_popular_stations()
+    display_popular_routes()
+    display_trip_density()
     average_ride_length()
     bike_types()
 elif selection_menu == 'Popular Hours':
@@ -528,6 +930,10 @@ elif selection_menu == 'Popular Months':
     display_popular_months()
 elif selection_menu == 'Popular Stations':
     display_popular_stations()
+elif selection_menu == 'Popular Routes':
+    display_popular_routes()
+elif selection_menu == 'Trip Density':
+    display_trip_density()
 elif selection_menu == 'Average Ride Length':
     average_ride_length()
 elif selection_menu == 'Bike Types':
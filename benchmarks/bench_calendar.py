@@ -0,0 +1,60 @@
+"""
+Benchmark - parsing started_at/ended_at and deriving the calendar columns: pd.to_datetime
+and .dt accessors vs parse_times and calendar_columns
+
+Run it from the repo root:
+    python -m benchmarks.bench_calendar --rows 1000000
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from divvy import calendar_columns, parse_times
+from benchmarks.common import make_trips, best_time
+
+
+def calendar_original(divvy_original):
+    """function with the original parsing, ride_length, day_of_week, month, and hour"""
+    started_at = pd.to_datetime(divvy_original['started_at'], format='%Y-%m-%d %H:%M:%S')
+    ended_at = pd.to_datetime(divvy_original['ended_at'], format='%Y-%m-%d %H:%M:%S')
+
+    return {
+        'ride_length': (ended_at - started_at).dt.total_seconds().to_numpy(),
+        'day_of_week': started_at.dt.weekday.astype('int8').to_numpy(),
+        'month': started_at.dt.month.to_numpy(),
+        'hour': started_at.dt.hour.to_numpy(),
+    }
+
+
+def calendar_fast(divvy_original):
+    """function with parse_times and calendar_columns of prepare_trips"""
+    return calendar_columns(parse_times(divvy_original['started_at']), \
+                            parse_times(divvy_original['ended_at']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # The times as they come out of the csv files, strings in an object column
+    trips = make_trips(args.rows)
+    divvy_original = pd.DataFrame({column: trips[column].dt.strftime('%Y-%m-%d %H:%M:%S') \
+                                   .astype(object) for column in ('started_at', 'ended_at')})
+
+    # Both ways have to give the same columns before we compare their timings
+    original, fast = calendar_original(divvy_original), calendar_fast(divvy_original)
+    for column, values in original.items():
+        np.testing.assert_array_equal(values, fast[column])
+
+    original_time = best_time(lambda: calendar_original(divvy_original), args.repeat)
+    fast_time = best_time(lambda: calendar_fast(divvy_original), args.repeat)
+
+    print(f"rows: {args.rows:,}")
+    print(f"pd.to_datetime + .dt:            {original_time:.3f} s")
+    print(f"parse_times + calendar_columns:  {fast_time:.3f} s "
+          f"({original_time / fast_time:.1f}x faster)")
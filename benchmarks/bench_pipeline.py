@@ -0,0 +1,125 @@
+"""
+Benchmark - profile every stage of divvy.py on synthetic monthly csv files (see synthetic.py)
+
+Run it from the repo root:
+    python -m benchmarks.bench_pipeline --scale 0.2
+    python -m benchmarks.bench_pipeline --scale 0.2 --streaming --output profile.json
+
+Compare a new run with the profile of an older one, the exit code is 1 if any stage got
+more than --tolerance slower:
+    python -m benchmarks.bench_pipeline --scale 0.2 --baseline profile.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from divvy import BACKENDS, CHUNK_SIZE, STATION_RADIUS, build_outputs, build_station_index, \
+                  count_files, month_fingerprints, read_bicycle_stations, start_profile, \
+                  stop_profile, write_artifacts, write_profile
+from benchmarks.synthetic import write_year
+
+
+def run_pipeline(paths, folder, args, memory=False):
+    """function to run the whole pipeline of divvy.py on the csv files, with the profiler on"""
+    start_profile(memory)
+
+    divvy_bicycle_stations = read_bicycle_stations()
+    divvy_station_index = build_station_index(divvy_bicycle_stations, args.station_radius) \
+                                if args.station_radius > 0 else None
+
+    divvy_counts = count_files(paths, streaming=args.streaming, chunksize=args.chunksize,
+                               cache_dir=os.path.join(folder, 'divvy_cache') if args.cache \
+                                            else None,
+                               workers=args.workers, station_index=divvy_station_index,
+                               backend=args.backend)
+    write_artifacts(divvy_counts, build_outputs(divvy_counts, divvy_bicycle_stations), \
+                    month_fingerprints(paths), os.path.join(folder, 'divvy_artifacts'))
+
+    return stop_profile()
+
+
+def compare_profiles(profile, baseline, tolerance, min_seconds):
+    """function to list the stages that got slower than the baseline (stage, before, after)"""
+    before = {line['stage']: line['self_seconds'] for line in baseline['stages']}
+
+    # Very short stages are mostly noise, so they're skipped
+    return [(line['stage'], before[line['stage']], line['self_seconds']) \
+            for line in profile['stages'] if line['stage'] in before \
+            and max(line['self_seconds'], before[line['stage']]) >= min_seconds \
+            and line['self_seconds'] > before[line['stage']] * (1 + tolerance)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=0.2,
+                        help="volume of the synthetic year, 1 is about 5.7 million trips")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=BACKENDS, default='pandas')
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--cache', action='store_true',
+                        help="run twice with a cache folder, the second run is profiled")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--station-radius', type=float, default=STATION_RADIUS)
+    parser.add_argument('--memory', action='store_true',
+                        help="profile the peak memory of every stage in one more run (its "
+                             "times are slowed down by tracemalloc, so they're not compared)")
+    parser.add_argument('--output', default=None,
+                        help="write the settings and the profile as JSON to this file")
+    parser.add_argument('--baseline', default=None,
+                        help="profile of an older run (--output) to compare this run with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="how much slower a stage may get than in the baseline")
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help="stages shorter than this are not compared")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        paths = write_year(folder, args.scale, seed=args.seed)
+
+        if args.cache:
+            run_pipeline(paths, folder, args)
+        profile = run_pipeline(paths, folder, args)
+
+        # tracemalloc slows some stages down much more than others, so the peak memory
+        #  comes from a separate run and the times of that run are thrown away
+        peak_memory = {}
+        if args.memory:
+            peak_memory = {line['stage']: line['peak_memory_mb'] for line \
+                           in run_pipeline(paths, folder, args, memory=True)['stages']}
+
+    # The stages are timed with their own time only (self_seconds), so a slower stage
+    #  doesn't make every stage around it look slower too
+    print(f"scale: {args.scale}, total: {profile['seconds']:.3f} s")
+    print(f"{'stage':<60} {'calls':>6} {'self s':>8} {'rows in':>10} {'rows out':>10} "
+          f"{'peak MB':>8}")
+    for line in profile['stages']:
+        peak = peak_memory.get(line['stage'])
+        print(f"{line['stage']:<60} {line['calls']:>6} {line['self_seconds']:>8.3f} "
+              f"{line['rows_in'] if line['rows_in'] is not None else '':>10} "
+              f"{line['rows_out'] if line['rows_out'] is not None else '':>10} "
+              f"{f'{peak:.1f}' if peak is not None else '':>8}")
+
+    if args.output:
+        write_profile(dict(profile, settings=vars(args), peak_memory_mb=peak_memory), \
+                      args.output)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+
+        slower = compare_profiles(profile, baseline, args.tolerance, args.min_seconds)
+        for name, before, after in slower:
+            print(f"slower: {name} {before:.3f} s -> {after:.3f} s")
+
+        if baseline.get('settings', {}).get('scale') != args.scale:
+            print("note: the baseline was run with a different scale")
+        # Profiles of older versions were always timed with tracemalloc on
+        if baseline.get('memory', True):
+            print("note: the baseline was timed with tracemalloc on, its times are slower")
+
+        sys.exit(1 if slower else 0)
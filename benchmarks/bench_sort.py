@@ -0,0 +1,63 @@
+"""
+Benchmark - sorting the trips by started_at: whole year vs month by month vs not at all
+
+Run it from the repo root:
+    python -m benchmarks.bench_sort --rows 1000000
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from divvy import concat_trips
+from benchmarks.common import make_trips, best_time
+
+
+def shuffle_a_little(divvy_month, fraction, rng):
+    """function to swap a small fraction of the rows, so the month is only nearly sorted"""
+    rows = np.arange(len(divvy_month))
+    swapped = rng.choice(rows, int(len(rows) * fraction), replace=False)
+    rows[swapped] = rng.permutation(swapped)
+
+    return divvy_month.take(rows).reset_index(drop=True)
+
+
+def sort_full(divvy_months):
+    """function with the original sort of the whole year"""
+    return concat_trips(divvy_months).sort_values(by='started_at', ascending=True)
+
+
+def sort_month(divvy_months):
+    """function with sort='month' of read_trips"""
+    return concat_trips([divvy_month if divvy_month['started_at'].is_monotonic_increasing \
+                         else divvy_month.sort_values(by='started_at', kind='stable') \
+                         for divvy_month in divvy_months])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--shuffled', type=float, default=0.01,
+                        help="fraction of the rows of every month that are out of order")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    trips = make_trips(args.rows)
+    divvy_months = [shuffle_a_little(divvy_month, args.shuffled, rng) for _, divvy_month \
+                    in trips.groupby(trips['started_at'].dt.month)]
+
+    # Both ways have to give the same order before we compare their timings
+    pd.testing.assert_series_equal(sort_full(divvy_months)['started_at'].reset_index(drop=True),
+                                   sort_month(divvy_months)['started_at'])
+
+    full = best_time(lambda: sort_full(divvy_months), args.repeat)
+    month = best_time(lambda: sort_month(divvy_months), args.repeat)
+    none = best_time(lambda: concat_trips(divvy_months), args.repeat)
+
+    print(f"rows: {args.rows:,} ({args.shuffled:.0%} of every month out of order)")
+    print(f"sort='full':  {full:.3f} s")
+    print(f"sort='month': {month:.3f} s ({full / month:.1f}x faster)")
+    print(f"sort='none':  {none:.3f} s ({full / none:.1f}x faster)")
@@ -0,0 +1,41 @@
+"""
+Benchmark - Data Cleaning Part 5, applymap(str.strip) vs strip_whitespace()
+
+Run it from the repo root:
+    python -m benchmarks.bench_strip_whitespace --rows 1000000
+"""
+
+import argparse
+
+import pandas as pd
+
+from divvy import strip_whitespace
+from benchmarks.common import make_trips, best_time
+
+
+def strip_with_applymap(dataframe):
+    """function with the original Data Cleaning Part 5 step"""
+    return dataframe.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    divvy_cleaned_4 = make_trips(args.rows)
+
+    # Both versions have to agree before we compare their timings (applymap also
+    #  upcasts int32 columns to int64, so let's only compare the values)
+    # strip_whitespace() works in place, so it gets a fresh copy every time
+    pd.testing.assert_frame_equal(strip_with_applymap(divvy_cleaned_4),
+                                  strip_whitespace(divvy_cleaned_4.copy()), check_dtype=False)
+
+    before = best_time(lambda: strip_with_applymap(divvy_cleaned_4), args.repeat)
+    after = best_time(lambda: strip_whitespace(divvy_cleaned_4.copy()), args.repeat)
+
+    print(f"rows: {args.rows:,}")
+    print(f"applymap(str.strip): {before:.3f} s")
+    print(f"strip_whitespace():  {after:.3f} s ({before / after:.1f}x faster)")
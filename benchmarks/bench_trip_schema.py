@@ -0,0 +1,43 @@
+"""
+Benchmark - bytes per row of the trips, default read_csv dtypes vs TRIP_DTYPES
+
+Run it from the repo root:
+    python -m benchmarks.bench_trip_schema --rows 1000000
+"""
+
+import argparse
+import os
+import tempfile
+
+import pandas as pd
+
+from divvy import read_csv_options, prepare_trips, clean_trips
+from benchmarks.common import make_trips
+
+
+def bytes_per_row(dataframe):
+    """function to measure the memory used per row, strings included"""
+    return dataframe.memory_usage(deep=True).sum() / max(len(dataframe), 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    # Let's write the trips as a csv file, just like the monthly divvy_tripdata files
+    trips = make_trips(args.rows).drop(columns=['ride_length', 'day_of_week', 'month', \
+                                                'hour'])
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'divvy_tripdata_synthetic.csv')
+        trips.to_csv(path, index=False, date_format='%Y-%m-%d %H:%M:%S')
+
+        divvy_default = pd.read_csv(path)
+        divvy_schema = pd.read_csv(path, **read_csv_options())
+
+    print(f"rows: {args.rows:,}")
+    print(f"read_csv, default dtypes: {bytes_per_row(divvy_default):7.1f} bytes per row")
+    print(f"read_csv, TRIP_DTYPES:    {bytes_per_row(divvy_schema):7.1f} bytes per row")
+    print(f"cleaned trips:            "
+          f"{bytes_per_row(clean_trips(prepare_trips(divvy_schema))):7.1f} bytes per row")
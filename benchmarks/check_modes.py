@@ -0,0 +1,118 @@
+"""
+Check - every way of running divvy.py counts exactly the same trips
+
+Writes a synthetic year (see synthetic.py) and copies some trips of every month to the end
+of the month after it, so ride_ids show up again in another month (and, with small chunks,
+in another chunk). The year is then counted in the default (eager) mode, in streaming mode,
+with a cache (first cleaned, then read back), with several workers, as a saved state with
+the other months appended, and with the duckdb backend if duckdb is installed. The exit
+code is 1 if any of them counts different trips than the eager mode.
+
+Run it from the repo root:
+    python -m benchmarks.check_modes --scale 0.05
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from divvy import STATION_RADIUS, append_months, build_station_index, count_files, \
+                  load_state, month_fingerprints, read_bicycle_stations, save_state, \
+                  seen_ride_ids
+from benchmarks.synthetic import write_year
+
+
+def copy_trips(paths, rows, seed=0):
+    """function to copy some trips of every month to the end of the month after it"""
+    rng = np.random.default_rng(seed)
+    for path, next_path in zip(paths, paths[1:]):
+        # The values are copied just like they are in the csv file
+        trips = pd.read_csv(path, dtype=str, keep_default_na=False)
+        trips.take(rng.choice(len(trips), min(rows, len(trips)), replace=False)) \
+             .to_csv(next_path, mode='a', header=False, index=False)
+
+
+def count_appended(paths, folder, station_index):
+    """function to count the first months into a saved state, and then append the others"""
+    state_path = os.path.join(folder, 'divvy_state.npz')
+    seen = seen_ride_ids()
+    counts = count_files(paths[:len(paths) // 2], station_index=station_index, seen=seen)
+    save_state(counts, month_fingerprints(paths[:len(paths) // 2]), seen, state_path, \
+               station_index=station_index)
+
+    append_months(paths[len(paths) // 2:], state_path, station_index=station_index)
+    counts, _, seen = load_state(state_path, station_index=station_index)
+
+    return counts, seen['hashes']
+
+
+def same_counts(counts, expected):
+    """function to check that two sets of partial aggregates are exactly the same"""
+    return all(np.array_equal(counts[key], expected[key]) \
+               for key in ('trips', 'ride_length', 'points')) \
+           and counts['stations'].equals(expected['stations']) \
+           and all(np.array_equal(counts['flows'][key], expected['flows'][key]) \
+                   for key in ('stations', 'keys', 'counts'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=0.05,
+                        help="volume of the synthetic year, 1 is about 5.7 million trips")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--copies', type=int, default=200,
+                        help="trips of every month copied to the month after it")
+    parser.add_argument('--chunksize', type=int, default=20_000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--station-radius', type=float, default=STATION_RADIUS)
+    args = parser.parse_args()
+
+    divvy_bicycle_stations = read_bicycle_stations()
+    divvy_station_index = build_station_index(divvy_bicycle_stations, args.station_radius) \
+                                if args.station_radius > 0 else None
+
+    with tempfile.TemporaryDirectory() as folder:
+        paths = write_year(folder, args.scale, seed=args.seed)
+        copy_trips(paths, args.copies, seed=args.seed)
+        cache_dir = os.path.join(folder, 'divvy_cache')
+
+        modes = {
+            'eager': {},
+            'streaming': {'streaming': True, 'chunksize': args.chunksize},
+            'cache (cleaned)': {'cache_dir': cache_dir, 'streaming': True, \
+                                'chunksize': args.chunksize},
+            'cache (read back)': {'cache_dir': cache_dir, 'streaming': True, \
+                                  'chunksize': args.chunksize},
+            'workers': {'workers': args.workers, 'streaming': True, 'chunksize': args.chunksize},
+            'duckdb': {'backend': 'duckdb'},
+        }
+
+        results = {}
+        for mode, options in modes.items():
+            if options.get('backend') == 'duckdb':
+                try:
+                    import duckdb  # noqa: F401
+                except ImportError:
+                    print(f"{mode}: skipped, duckdb is not installed")
+                    continue
+
+            seen = seen_ride_ids()
+            results[mode] = count_files(paths, station_index=divvy_station_index, seen=seen, \
+                                        **options), seen['hashes']
+
+        results['append'] = count_appended(paths, folder, divvy_station_index)
+
+    expected, expected_hashes = results['eager']
+    different = []
+    for mode, (counts, hashes) in results.items():
+        same = same_counts(counts, expected) and np.array_equal(hashes, expected_hashes)
+        print(f"{mode}: {counts['trips'].sum():,} trips, {'same' if same else 'DIFFERENT'}")
+        if not same:
+            different.append(mode)
+
+    sys.exit(1 if different else 0)
@@ -0,0 +1,54 @@
+"""
+Shared helpers for the benchmarks - Divvy-shaped trips without the real csv files
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def make_trips(rows, seed=0, stations_path="divvy_bicycle_stations.csv"):
+    """function to build a cleaned-looking trips dataframe with real station names"""
+    rng = np.random.default_rng(seed)
+    station_names = pd.read_csv(stations_path)['Station Name'].to_numpy()
+
+    # Trips are spread over the twelve months of 2022 and sorted within every month,
+    #  just like the monthly csv files
+    started_at = pd.Timestamp('2022-01-01') + pd.to_timedelta(np.sort(rng.integers(\
+                                    0, 365 * 24 * 3600, rows)), unit='s')
+    ride_length = rng.integers(60, 3600, rows)
+
+    start_station = rng.integers(0, len(station_names), rows)
+    end_station = rng.integers(0, len(station_names), rows)
+
+    return pd.DataFrame({
+        'ride_id': [f"{value:016X}" for value in rng.integers(0, 2**63, rows)],
+        'rideable_type': rng.choice(['classic_bike', 'electric_bike', 'docked_bike'], rows),
+        'started_at': started_at,
+        'ended_at': started_at + pd.to_timedelta(ride_length, unit='s'),
+        'start_station_name': station_names[start_station],
+        'start_station_id': start_station.astype(str),
+        'end_station_name': station_names[end_station],
+        'end_station_id': end_station.astype(str),
+        'start_lat': rng.uniform(41.65, 42.07, rows),
+        'start_lng': rng.uniform(-87.83, -87.52, rows),
+        'end_lat': rng.uniform(41.65, 42.07, rows),
+        'end_lng': rng.uniform(-87.83, -87.52, rows),
+        'member_casual': rng.choice(['member', 'casual'], rows, p=[0.6, 0.4]),
+        'ride_length': ride_length.astype(float),
+        'day_of_week': started_at.weekday.astype('int8'),
+        'month': started_at.month.astype('int8'),
+        'hour': started_at.hour.astype('int8'),
+    })
+
+
+def best_time(function, repeat=3):
+    """function to run function repeat times and return the best wall time in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
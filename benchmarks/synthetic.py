@@ -0,0 +1,378 @@
+"""
+Synthetic Divvy trip data - monthly divvy_tripdata csv files that look like the real ones
+
+The trips start and end at the stations of divvy_bicycle_stations.csv (popular stations
+near the Loop and the lakefront get more trips, and most trips end at a nearby station).
+Months, days of the week, and hours follow roughly the patterns of 2022 for members and
+casual riders, and the files have the same problems the cleaning steps of divvy.py are
+written for: test stations, station names ending with "*", "(Temp)", or "- Charging",
+empty values and "NULL"-like values, dockless e-bikes without a station, duplicate
+ride_ids, extra white spaces, and rides shorter than 60 seconds.
+
+Every day is generated on its own (with its own random seed), and the days are written in
+chunks of about --chunksize rows, so memory stays flat at any volume and the files don't
+depend on the chunk size. Run it from the repo root:
+    python -m benchmarks.synthetic --scale 1 --folder synthetic
+    python -m benchmarks.synthetic --scale 10 --folder synthetic --year 2023
+    python -m benchmarks.synthetic --scale 100 --folder /data/synthetic --chunksize 2000000
+
+--scale 1 is the volume of 2022 (about 5.7 million trips), so --scale 10 is about 57 million.
+"""
+
+import argparse
+import calendar
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+
+# %%
+## Volume - trips per month in 2022, --scale 1 writes the same number of trips
+MONTH_TRIPS = (103770, 115609, 284042, 371249, 634858, 769204,
+               823488, 785932, 701339, 558685, 337735, 181806)
+
+# Share of casual riders per month, casual riders are mostly a summer thing
+CASUAL_SHARE = (0.18, 0.19, 0.32, 0.34, 0.44, 0.48, 0.49, 0.46, 0.42, 0.37, 0.27, 0.22)
+
+## Seasonality - trips per hour of the day for members and casual riders, on weekdays
+#  (commuting peaks at 8 and 17 o'clock) and weekends (one long afternoon peak)
+HOUR_WEIGHTS = {
+    ('member', False): (12, 7, 4, 3, 4, 14, 42, 80, 95, 60, 48, 55,
+                        65, 64, 66, 80, 118, 150, 110, 78, 55, 40, 30, 19),
+    ('member', True): (22, 15, 9, 5, 4, 6, 13, 25, 42, 58, 72, 82,
+                       88, 88, 86, 84, 82, 78, 66, 52, 40, 33, 28, 22),
+    ('casual', False): (18, 12, 7, 4, 3, 6, 14, 26, 30, 30, 38, 50,
+                        60, 64, 70, 82, 100, 116, 98, 76, 58, 48, 40, 28),
+    ('casual', True): (30, 22, 14, 8, 5, 5, 9, 18, 32, 52, 74, 94,
+                       108, 114, 116, 114, 108, 100, 86, 68, 54, 46, 40, 32),
+}
+
+# Trips per day of the week (Monday is 0), members ride on weekdays and casual riders
+#  on weekends. Every day also gets some random "weather" shared by both
+DAY_WEIGHTS = {
+    'member': (1.05, 1.1, 1.1, 1.1, 1.0, 0.85, 0.8),
+    'casual': (0.8, 0.75, 0.8, 0.85, 1.0, 1.4, 1.35),
+}
+WEATHER_SIGMA = 0.3
+
+## Bikes - share of every rideable type, docked bikes are only used by casual riders
+RIDEABLE_TYPES = ('classic_bike', 'docked_bike', 'electric_bike')
+RIDEABLE_SHARE = {
+    'member': (0.51, 0.0, 0.49),
+    'casual': (0.37, 0.08, 0.55),
+}
+
+## Stations and routes - a trip ends at the start station (a round trip) or at one of the
+#  NEIGHBORS nearest stations, picked by popularity and distance
+NEIGHBORS = 32
+ROUND_TRIP_SHARE = {'member': 0.03, 'casual': 0.12}
+ROUTE_DISTANCE = 1500           # meters, nearby stations are more likely to be picked
+LOOP = (41.8819, -87.6278)      # stations near the Loop and the lakefront are busier
+LOOP_DISTANCE = 8000            # meters
+
+# Riding speed in meters per second (e-bikes are 25% faster), plus some time for stops
+SPEED = {'member': 4.0, 'casual': 3.2}
+ELECTRIC_SPEED = 1.25
+
+## Dirty data - the share of trips with every problem cleaned up by divvy.py
+NO_START_STATION_SHARE = 0.28   # of the e-bike trips, parked away from a station
+NO_END_STATION_SHARE = 0.30     # of the e-bike trips
+NO_END_POINT_SHARE = 0.001      # lost or stolen bikes, without end station or coordinates
+SENTINEL_SHARE = 0.0005         # station ids written as "NULL", "N/A", ...
+SHORT_SHARE = 0.015             # false starts and re-docks below 60 seconds
+TEST_SHARE = 0.0005             # trips from or to a test/maintenance station
+DUPLICATE_SHARE = 0.0001        # ride_ids listed twice
+WHITESPACE_SHARE = 0.001        # station names with extra white spaces
+
+# Some stations show up with a suffix in part of their trips (see clean_trips of divvy.py)
+SUFFIXES = ('*', ' (Temp)', ' - Charging')
+SUFFIX_STATION_SHARE = 0.05
+SUFFIX_TRIP_SHARE = 0.3
+
+TEST_STATIONS = [
+    ('WEST CHI-WATSON', 'DIVVY 001 - Warehouse test station'),
+    ('DIVVY CASSETTE REPAIR MOBILE STATION', 'DIVVY CASSETTE REPAIR MOBILE STATION'),
+    ('Pawel Bialowas - Test- PBSC charging station', \
+     'Pawel Bialowas - Test- PBSC charging station'),
+    ('Hubbard Bike-checking (LBS-WH-TEST)', 'Hubbard Bike-checking (LBS-WH-TEST)'),
+    ('Base - 2132 W Hubbard Warehouse', 'Hubbard Bike-checking (LBS-WH-TEST)'),
+]
+SENTINELS = ('NULL', 'N/A', 'NaN', 'NA')
+
+# Columns of the real monthly csv files, in the same order
+TRIP_SCHEMA = pa.schema([(column, pa.string()) for column in ( \
+                            'ride_id', 'rideable_type', 'started_at', 'ended_at',
+                            'start_station_name', 'start_station_id', 'end_station_name',
+                            'end_station_id')] \
+                        + [(column, pa.float64()) for column in ( \
+                            'start_lat', 'start_lng', 'end_lat', 'end_lng')] \
+                        + [('member_casual', pa.string())])
+
+CHUNK_SIZE = 1_000_000
+
+
+# %%
+## Stations - names, ids, coordinates, popularity, and the nearest stations of every station
+def read_stations(path="divvy_bicycle_stations.csv", seed=0):
+    """function to read the stations with a location, with their popularity and neighbors"""
+    stations = pd.read_csv(path, dtype={'ID': str}).dropna(subset=['Latitude', 'Longitude'])
+    rng = np.random.default_rng([seed, 0])
+
+    latitude = stations['Latitude'].to_numpy()
+    longitude = stations['Longitude'].to_numpy()
+
+    # Distances in meters on a flat map, close enough over the size of Chicago
+    y = (latitude - LOOP[0]) * 111_320
+    x = (longitude - LOOP[1]) * 111_320 * np.cos(np.radians(LOOP[0]))
+    popularity = rng.lognormal(0, 1, len(stations)) \
+                    * (np.exp(-np.hypot(x, y) / LOOP_DISTANCE) + 0.05)
+
+    # Let's pick the nearest stations of every station once, the first one is itself
+    distance = np.hypot(x[:, None] - x[None, :], y[:, None] - y[None, :])
+    neighbors = np.argsort(distance, axis=1, kind='stable')[:, 1:NEIGHBORS + 1]
+    neighbor_distance = np.take_along_axis(distance, neighbors, axis=1)
+
+    # Cumulative weights per row, so picking a neighbor is a search over a row
+    route_weights = popularity[neighbors] * np.exp(-neighbor_distance / ROUTE_DISTANCE)
+    route_weights = np.cumsum(route_weights, axis=1)
+    route_weights /= route_weights[:, -1:]
+
+    # Some stations show up with a suffix too, e.g. "Foo St (Temp)" next to "Foo St"
+    names = stations['Station Name'].to_numpy(dtype=object)
+    suffixed = rng.random(len(stations)) < SUFFIX_STATION_SHARE
+    suffix_names = names.copy()
+    suffix_names[suffixed] = names[suffixed] + rng.choice(SUFFIXES, suffixed.sum())
+
+    return {
+        'names': names,
+        'suffix_names': suffix_names,
+        'ids': stations['ID'].to_numpy(dtype=object),
+        'latitude': latitude,
+        'longitude': longitude,
+        'popularity': popularity / popularity.sum(),
+        'neighbors': neighbors,
+        'neighbor_distance': neighbor_distance,
+        'route_weights': route_weights,
+    }
+
+
+# %%
+## Trips - one day at a time
+def day_counts(year, month, scale, seed=0):
+    """function to split the trips of a month into members/casual riders per day"""
+    rng = np.random.default_rng([seed, year, month])
+    days = calendar.monthrange(year, month)[1]
+    weekdays = (np.arange(days) + calendar.weekday(year, month, 1)) % 7
+    weather = rng.lognormal(0, WEATHER_SIGMA, days)
+
+    trips = int(round(MONTH_TRIPS[month - 1] * scale))
+    casual = rng.binomial(trips, CASUAL_SHARE[month - 1])
+
+    counts = {}
+    for member_casual, riders in (('member', trips - casual), ('casual', casual)):
+        weights = np.asarray(DAY_WEIGHTS[member_casual])[weekdays] * weather
+        counts[member_casual] = rng.multinomial(riders, weights / weights.sum())
+
+    return counts
+
+
+def make_day_trips(stations, year, month, day, counts, seed=0):
+    """function to generate the (raw, uncleaned) trips of one day, sorted by started_at"""
+    rng = np.random.default_rng([seed, year, month, day])
+    weekend = calendar.weekday(year, month, day) >= 5
+    member_casual = np.repeat(np.array(['member', 'casual'], dtype=object), \
+                              [counts['member'], counts['casual']])
+    rows = len(member_casual)
+    is_casual = member_casual == 'casual'
+
+    ## When - the hour of the day depends on the rider type and the day of the week
+    seconds = np.empty(rows, dtype='int64')
+    rideable_type = np.empty(rows, dtype=object)
+    for rider, riders in (('member', ~is_casual), ('casual', is_casual)):
+        hours = np.asarray(HOUR_WEIGHTS[(rider, weekend)], dtype=float)
+        seconds[riders] = rng.choice(24, riders.sum(), p=hours / hours.sum()) * 3600
+        rideable_type[riders] = rng.choice(RIDEABLE_TYPES, riders.sum(), \
+                                           p=RIDEABLE_SHARE[rider])
+    seconds += rng.integers(0, 3600, rows)
+    is_electric = rideable_type == 'electric_bike'
+
+    ## Where - popular start stations, and a nearby (or the same) end station
+    start = rng.choice(len(stations['names']), rows, p=stations['popularity'])
+    neighbor = (stations['route_weights'][start] < rng.random(rows)[:, None]).sum(axis=1)
+    end = stations['neighbors'][start, neighbor]
+    distance = stations['neighbor_distance'][start, neighbor]
+
+    round_trip = rng.random(rows) < np.where(is_casual, ROUND_TRIP_SHARE['casual'], \
+                                             ROUND_TRIP_SHARE['member'])
+    end[round_trip] = start[round_trip]
+    distance[round_trip] = 0
+
+    ## How long - riding the (detour of the) distance, or a long round trip
+    speed = np.where(is_casual, SPEED['casual'], SPEED['member']) \
+                * np.where(is_electric, ELECTRIC_SPEED, 1)
+    ride_length = distance * 1.3 / speed + rng.lognormal(np.log(180), 0.8, rows)
+    ride_length[round_trip] = rng.lognormal(np.log(1500), 0.9, round_trip.sum())
+
+    short = rng.random(rows) < SHORT_SHARE
+    ride_length[short] = rng.integers(-5, 60, short.sum())
+    ride_length = np.minimum(ride_length, 24 * 3600).astype('int64')
+
+    # Let's sort the trips of the day by started_at, just like the monthly csv files
+    order = np.argsort(seconds, kind='stable')
+    seconds, ride_length, member_casual, rideable_type, is_electric, start, end = \
+        (values[order] for values in (seconds, ride_length, member_casual, rideable_type, \
+                                      is_electric, start, end))
+
+    started_at = np.datetime64(f"{year}-{month:02d}-{day:02d}", 's') + seconds
+    ended_at = started_at + ride_length
+
+    ## Coordinates - e-bikes have GPS coordinates around the station, the others have the
+    #  coordinates of the dock
+    start_lat = stations['latitude'][start] + is_electric * rng.normal(0, 0.0002, rows)
+    start_lng = stations['longitude'][start] + is_electric * rng.normal(0, 0.0003, rows)
+    end_lat = stations['latitude'][end] + is_electric * rng.normal(0, 0.0002, rows)
+    end_lng = stations['longitude'][end] + is_electric * rng.normal(0, 0.0003, rows)
+
+    # Station names sometimes come with a suffix
+    start_station_name = np.where(rng.random(rows) < SUFFIX_TRIP_SHARE, \
+                                  stations['suffix_names'][start], stations['names'][start])
+    end_station_name = np.where(rng.random(rows) < SUFFIX_TRIP_SHARE, \
+                                stations['suffix_names'][end], stations['names'][end])
+    start_station_id = stations['ids'][start]
+    end_station_id = stations['ids'][end]
+
+    ## Dirty data - every problem divvy.py cleans up
+    # Dockless e-bikes are parked away from a station, their coordinates only have two
+    #  decimals and they're farther away
+    no_start = is_electric & (rng.random(rows) < NO_START_STATION_SHARE)
+    no_end = is_electric & (rng.random(rows) < NO_END_STATION_SHARE)
+    start_lat[no_start] = np.round(start_lat[no_start] + rng.normal(0, 0.003, no_start.sum()), 2)
+    start_lng[no_start] = np.round(start_lng[no_start] + rng.normal(0, 0.004, no_start.sum()), 2)
+    end_lat[no_end] = np.round(end_lat[no_end] + rng.normal(0, 0.003, no_end.sum()), 2)
+    end_lng[no_end] = np.round(end_lng[no_end] + rng.normal(0, 0.004, no_end.sum()), 2)
+    start_station_name[no_start] = None
+    start_station_id[no_start] = None
+
+    # Lost bikes don't have an end station or end coordinates at all
+    no_end_point = rng.random(rows) < NO_END_POINT_SHARE
+    no_end |= no_end_point
+    end_lat[no_end_point] = np.nan
+    end_lng[no_end_point] = np.nan
+    end_station_name[no_end] = None
+    end_station_id[no_end] = None
+
+    sentinel = rng.random(rows) < SENTINEL_SHARE
+    start_station_id[sentinel] = rng.choice(SENTINELS, sentinel.sum())
+
+    # Test and maintenance stations, at the start or at the end
+    test = np.flatnonzero(rng.random(rows) < TEST_SHARE)
+    test_station = rng.integers(0, len(TEST_STATIONS), len(test))
+    test_names, test_ids = (np.array(values, dtype=object)[test_station] \
+                            for values in zip(*TEST_STATIONS))
+    at_start = rng.random(len(test)) < 0.5
+    start_station_name[test[at_start]] = test_names[at_start]
+    start_station_id[test[at_start]] = test_ids[at_start]
+    end_station_name[test[~at_start]] = test_names[~at_start]
+    end_station_id[test[~at_start]] = test_ids[~at_start]
+
+    whitespace = np.flatnonzero((rng.random(rows) < WHITESPACE_SHARE) \
+                                & pd.notna(start_station_name))
+    start_station_name[whitespace] = ' ' + start_station_name[whitespace] + '  '
+
+    ride_id = make_ride_ids(rng, rows)
+    duplicate = np.flatnonzero(rng.random(rows) < DUPLICATE_SHARE)
+    ride_id[duplicate] = ride_id[rng.integers(0, rows, len(duplicate))]
+
+    return pa.table({
+        'ride_id': pa.array(ride_id, pa.binary()).cast(pa.string()),
+        'rideable_type': rideable_type,
+        'started_at': format_times(started_at),
+        'ended_at': format_times(ended_at),
+        'start_station_name': start_station_name,
+        'start_station_id': start_station_id,
+        'end_station_name': end_station_name,
+        'end_station_id': end_station_id,
+        'start_lat': start_lat,
+        'start_lng': start_lng,
+        'end_lat': pa.array(end_lat, from_pandas=True),
+        'end_lng': pa.array(end_lng, from_pandas=True),
+        'member_casual': member_casual,
+    }, schema=TRIP_SCHEMA)
+
+
+def format_times(values):
+    """function to format datetime64 values like the csv files, e.g. 2022-01-01 00:00:00"""
+    # Arrow casts second timestamps to exactly this format, and ~10x faster than strftime
+    return pa.array(values).cast(pa.string())
+
+
+def make_ride_ids(rng, rows):
+    """function to make random 16 digit hexadecimal ride_ids, e.g. 6DDB2240A5A868DD"""
+    # Every random byte gives two digits, looked up in a table instead of formatting
+    #  every ride_id in Python
+    digits = np.frombuffer(b'0123456789ABCDEF', dtype='uint8')
+    random_bytes = rng.integers(0, 256, (rows, 8), dtype='uint8')
+
+    chars = np.empty((rows, 16), dtype='uint8')
+    chars[:, 0::2] = digits[random_bytes >> 4]
+    chars[:, 1::2] = digits[random_bytes & 15]
+
+    return chars.view('S16').ravel()
+
+
+# %%
+## Monthly csv files - the days are buffered into chunks of about chunksize rows
+def write_month(stations, folder, year, month, scale, seed=0, chunksize=CHUNK_SIZE):
+    """function to write one synthetic monthly csv file in chunks and return its path"""
+    path = os.path.join(folder, f"divvy_tripdata_{year}{month:02d}.csv")
+    counts = day_counts(year, month, scale, seed)
+
+    # The file is written to a temporary file first, so a stopped run doesn't leave a
+    #  half-written month behind
+    with pa_csv.CSVWriter(path + '.tmp', TRIP_SCHEMA) as writer:
+        chunk = []
+        for day in range(1, len(counts['member']) + 1):
+            chunk.append(make_day_trips(stations, year, month, day, \
+                                        {rider: counts[rider][day - 1] for rider in counts}, \
+                                        seed))
+            if sum(len(table) for table in chunk) >= chunksize:
+                writer.write_table(pa.concat_tables(chunk))
+                chunk = []
+
+        if chunk:
+            writer.write_table(pa.concat_tables(chunk))
+
+    os.replace(path + '.tmp', path)
+
+    return path
+
+
+def write_year(folder, scale=1.0, year=2022, seed=0, chunksize=CHUNK_SIZE, months=range(1, 13),
+               stations_path="divvy_bicycle_stations.csv"):
+    """function to write a year of synthetic monthly csv files into folder"""
+    os.makedirs(folder, exist_ok=True)
+    stations = read_stations(stations_path, seed)
+
+    return [write_month(stations, folder, year, month, scale, seed, chunksize) \
+            for month in months]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="volume of a year, 1 is about 5.7 million trips like 2022")
+    parser.add_argument('--folder', default='synthetic')
+    parser.add_argument('--year', type=int, default=2022)
+    parser.add_argument('--months', type=int, nargs='*', default=list(range(1, 13)))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE,
+                        help="rows written at once, this bounds the memory used")
+    args = parser.parse_args()
+
+    for path in write_year(args.folder, args.scale, args.year, args.seed, args.chunksize,
+                           args.months):
+        print(f"{path}: {os.path.getsize(path) / 1e6:,.1f} MB")
@@ -3,406 +3,2041 @@ Data Wrangling and Analysis Steps - Divvy bike trips data
 """
 
 ## Libraries
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import reduce, wraps
+from itertools import repeat
+
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 
 # %%
 ## Data Import (original csv files here are huge, you can
 # download them from https://divvybikes.com/system-data
 # and just change the csv names for consistency)
-divvy_202201 = pd.read_csv("divvy_tripdata_202201.csv")
-divvy_202202 = pd.read_csv("divvy_tripdata_202202.csv")
-divvy_202203 = pd.read_csv("divvy_tripdata_202203.csv")
-divvy_202204 = pd.read_csv("divvy_tripdata_202204.csv")
-divvy_202205 = pd.read_csv("divvy_tripdata_202205.csv")
-divvy_202206 = pd.read_csv("divvy_tripdata_202206.csv")
-divvy_202207 = pd.read_csv("divvy_tripdata_202207.csv")
-divvy_202208 = pd.read_csv("divvy_tripdata_202208.csv")
-divvy_202209 = pd.read_csv("divvy_tripdata_202209.csv")
-divvy_202210 = pd.read_csv("divvy_tripdata_202210.csv")
-divvy_202211 = pd.read_csv("divvy_tripdata_202211.csv")
-divvy_202212 = pd.read_csv("divvy_tripdata_202212.csv")
-
-
-## Combine the Dataframes
-divvy_2022_original = pd.concat([divvy_202201, divvy_202202, divvy_202203, divvy_202204,
-                                  divvy_202205, divvy_202206, divvy_202207, divvy_202208,
-                                  divvy_202209, divvy_202210, divvy_202211,
-                                  divvy_202212], axis=0)
-
-# Reset the row indices
-divvy_2022_original = divvy_2022_original.reset_index(drop=True)
+MONTH_FILES = [f"divvy_tripdata_2022{month:02d}.csv" for month in range(1, 13)]
+
+STATION_COLUMNS = ['start_station_name', 'start_station_id', 'end_station_name', 'end_station_id']
+
+## Trip Data Schema - compact dtypes, applied while the csv files are read.
+#  ride_id is an Arrow string, and the columns with few distinct values (station
+#  names and ids, bike types, member_casual) are categoricals. Station columns are
+#  always read as categoricals of strings, even if a chunk has no station at all
+TRIP_DTYPES = {
+    'ride_id': 'string[pyarrow]',
+    'rideable_type': 'category',
+    'start_station_name': 'category',
+    'start_station_id': 'category',
+    'end_station_name': 'category',
+    'end_station_id': 'category',
+    'start_lat': 'float32',
+    'start_lng': 'float32',
+    'end_lat': 'float32',
+    'end_lng': 'float32',
+    'member_casual': 'category',
+}
+
+# Just in case, let's convert all "NULL" or "NA" or "NaN" or "N/A" string values
+#  (regardless of their case) to actually empty values. I don't think they have
+#  these string values, but again, just in case
+NA_SENTINELS = ['NULL', 'N/A', 'NAN', 'NA']
+
+# The values pd.read_csv reads as empty values by default (see its na_values option),
+#  so the duckdb backend can read the csv files the same way
+DEFAULT_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+                     '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a',
+                     'nan', 'null']
+
+# Number of rows per chunk in streaming mode. Every chunk is cleaned and counted
+#  on its own, so memory stays flat no matter how many months we feed in
+CHUNK_SIZE = 500_000
+
+## Trip Cube - the axes (and their labels) that every trip is counted by, see count_trips.
+#  The labels are sorted, so the tables come out in the same order as a groupby
+MEMBER_TYPES = ['casual', 'member']
+
+CUBE_AXES = {
+    'member_casual': MEMBER_TYPES,
+    'rideable_type': ['classic_bike', 'docked_bike', 'electric_bike', 'electric_scooter'],
+    'month': np.arange(1, 13, dtype='int8'),
+    'day_of_week': np.arange(7, dtype='int8'),
+    'hour': np.arange(24, dtype='int8'),
+}
+
+CUBE_SHAPE = tuple(len(labels) for labels in CUBE_AXES.values())
+
+## Station Counts - the trips that start or end at every station (the count_total of the
+#  station tables), and the trips that only start there, per member_casual type. Like the
+#  original tables, a station is only listed if its member_casual type starts trips there
+STATION_COUNT_COLUMNS = MEMBER_TYPES + [f"{member_type}_start" for member_type in MEMBER_TYPES]
+
+## Trip Flows - the station-to-station trips are counted per member_casual, rideable_type,
+#  month, and hour (see sum_flows). Most station pairs never see a trip, so only the pairs
+#  with trips are kept, as sorted keys (one per bucket, start station, and end station) and
+#  counts. The station totals of any selection of buckets are sums over the trip flows too
+FLOW_AXES = {axis: CUBE_AXES[axis] for axis in ('member_casual', 'rideable_type', 'month', \
+                                                  'hour')}
+
+FLOW_SHAPE = tuple(len(labels) for labels in FLOW_AXES.values())
+
+## Trip Points - the start and end coordinates of every trip are counted per member_casual
+#  on a grid of about 110 x 110 meter cells over Chicago (see count_points). They're counted
+#  before Data Cleaning Part 2, so the trips without a station name (e.g. dockless e-bikes)
+#  are on the map too. The zoomed-out maps use coarser grids of POINT_LEVELS levels, every
+#  level adds up 2 x 2 cells of the level before (see point_levels)
+POINT_ENDS = ['start', 'end']
+POINT_ORIGIN = (41.6, -88.0)    # latitude and longitude of the south-west corner of the grid
+POINT_STEP = (0.001, 0.00135)   # height and width of a cell in degrees
+POINT_GRID = (512, 384)         # rows (south to north) and columns (west to east)
+POINT_LEVELS = 6
+
+POINT_SHAPE = (len(MEMBER_TYPES), len(POINT_ENDS)) + POINT_GRID
+
+# The trip cube, the trip flows, and the station tables are written here for app.py,
+#  listed in a manifest (see write_artifacts). ARTIFACT_FORMAT_VERSION changes whenever
+#  the layout of the artifacts changes, so app.py never reads artifacts it doesn't understand
+ARTIFACTS_DIR = "divvy_artifacts"
+ARTIFACT_FORMAT_VERSION = 2
+MANIFEST_FILE = "manifest.json"
+
+# Trips are matched to the nearest station of divvy_bicycle_stations.csv within this
+#  many meters of their start/end coordinates (see build_station_index)
+STATION_RADIUS = 50
+
+# The merged partial aggregates are saved here, so new months can be appended later
+STATE_PATH = "divvy_state.npz"
+
+# Ways to sort the trips by started_at before cleaning them (see read_trips)
+SORT_MODES = ('full', 'month', 'none')
+
+# Engines that can read, clean, and count the csv files (see count_files). The DuckDB
+#  backend spills to this folder when the trips don't fit in its memory limit
+BACKENDS = ('pandas', 'duckdb')
+DUCKDB_TEMP_DIR = "divvy_duckdb_tmp"
+
+# Cleaned months are cached as Parquet files in this folder (see iter_cleaned_month).
+#  CACHE_VERSION changes whenever CLEANED_SCHEMA changes, so older cache files are rebuilt
+CACHE_DIR = "divvy_cache"
+CACHE_VERSION = 2
+
+# With --profile, the stage profile is written here (see start_profile)
+PROFILE_PATH = "divvy_profile.json"
+
+# Column types of the cleaned trips cache, the same ones as TRIP_DTYPES (categoricals
+#  are stored dictionary encoded)
+CLEANED_SCHEMA = pa.schema([
+    ('ride_id', pa.string()),
+    ('rideable_type', pa.dictionary(pa.int32(), pa.string())),
+    ('started_at', pa.timestamp('ns')),
+    ('ended_at', pa.timestamp('ns')),
+    ('start_station_name', pa.dictionary(pa.int32(), pa.string())),
+    ('start_station_id', pa.dictionary(pa.int32(), pa.string())),
+    ('end_station_name', pa.dictionary(pa.int32(), pa.string())),
+    ('end_station_id', pa.dictionary(pa.int32(), pa.string())),
+    ('start_lat', pa.float32()),
+    ('start_lng', pa.float32()),
+    ('end_lat', pa.float32()),
+    ('end_lng', pa.float32()),
+    ('member_casual', pa.dictionary(pa.int32(), pa.string())),
+    ('ride_length', pa.float64()),
+    ('day_of_week', pa.int8()),
+    ('month', pa.int8()),
+    ('hour', pa.int8()),
+])
 
 
 # %%
-## Change the Dtype for started_at and ended_at since they are originally "object"
-divvy_2022_original['started_at'] = pd.to_datetime(divvy_2022_original\
-                                                   ['started_at'], format='%Y-%m-%d %H:%M:%S')
-divvy_2022_original['ended_at'] = pd.to_datetime(divvy_2022_original\
-                                                 ['ended_at'], format='%Y-%m-%d %H:%M:%S')
+## Stage Profiler - every step of the pipeline runs as a named stage. With --profile, every
+#  run of a stage records its wall time and its rows in and out (for dataframes). Stages
+#  that run inside another stage are named after it, e.g. "clean_trips/strip_whitespace",
+#  and the self_seconds of a stage leave out the time of the stages inside it. With
+#  --profile-memory, every stage also records its peak memory (of the numpy and Python
+#  allocations, measured with tracemalloc). tracemalloc hooks every allocation, which makes
+#  some stages (the ones with many small Python objects) a lot slower than others, so the
+#  stage times are only comparable between runs without it
+STAGE_PROFILE = {'records': None, 'stack': [], 'start': None, 'memory': False}
+
+
+def start_profile(memory=False):
+    """function to turn on the stage profiler (and memory tracing), with no records yet"""
+    STAGE_PROFILE.update(records=[], stack=[], start=time.perf_counter(), memory=memory)
+    if memory:
+        tracemalloc.start()
+
+
+def stop_profile():
+    """function to turn off the stage profiler, and return the records with a summary"""
+    records, memory = STAGE_PROFILE['records'], STAGE_PROFILE['memory']
+    seconds = time.perf_counter() - STAGE_PROFILE['start']
+    STAGE_PROFILE.update(records=None, stack=[], start=None, memory=False)
+    if memory:
+        tracemalloc.stop()
+
+    # One line per stage, in the order the stages were first finished
+    summary = {}
+    for record in records:
+        line = summary.setdefault(record['stage'], {'stage': record['stage'], 'calls': 0, \
+                                  'seconds': 0.0, 'self_seconds': 0.0, 'rows_in': None, \
+                                  'rows_out': None, 'peak_memory_mb': None})
+        line['calls'] += 1
+        line['seconds'] += record['seconds']
+        line['self_seconds'] += record['self_seconds']
+        if record['peak_memory_mb'] is not None:
+            line['peak_memory_mb'] = max(line['peak_memory_mb'] or 0.0, record['peak_memory_mb'])
+        for rows in ('rows_in', 'rows_out'):
+            if record[rows] is not None:
+                line[rows] = (line[rows] or 0) + record[rows]
+
+    return {'seconds': seconds, 'memory': memory, 'stages': list(summary.values()), \
+            'records': records}
+
+
+def write_profile(profile, path=None):
+    """function to write the profile of stop_profile as JSON, to a file or the screen ('-')"""
+    profile_json = json.dumps(profile, indent=2)
+
+    if path in (None, '-'):
+        print(profile_json)
+    else:
+        with open(path, 'w', encoding='utf-8') as profile_file:
+            profile_file.write(profile_json)
+
+
+def rows_of(value):
+    """function to get the number of rows of a dataframe (None for anything else)"""
+    # Chunks of cleaned trips come together with their trip points, see iter_cleaned_month
+    if isinstance(value, tuple):
+        value = value[0]
+
+    return len(value) if isinstance(value, pd.DataFrame) else None
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """function (a context manager) to profile the code of a with block as one stage"""
+    record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+    if STAGE_PROFILE['records'] is None:
+        yield record
+        return
+
+    stack = STAGE_PROFILE['stack']
+    if stack:
+        record['stage'] = f"{stack[-1]['stage']}/{name}"
+
+    # tracemalloc only keeps one peak, so every stage starts a new one. The peak so far
+    #  is handed to the stage around it first, and the peak of this stage after it
+    memory = STAGE_PROFILE['memory']
+    if memory:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        record['peak'] = current
+
+    record['child_seconds'] = 0.0
+    stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        record['self_seconds'] = record['seconds'] - record.pop('child_seconds')
+        stack.pop()
+        if stack:
+            stack[-1]['child_seconds'] += record['seconds']
+
+        record['peak_memory_mb'] = None
+        if memory:
+            peak = max(record.pop('peak'), tracemalloc.get_traced_memory()[1])
+            record['peak_memory_mb'] = (peak - current) / 2**20
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+
+        STAGE_PROFILE['records'].append(record)
+
+
+def profiled(name):
+    """function to profile every call of a function as one stage (a decorator)"""
+    def decorator(function):
+        @wraps(function)
+        def profiled_function(*args, **kwargs):
+            with stage(name, rows_of(args[0]) if args else None) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = rows_of(result)
+
+            return result
+
+        return profiled_function
+
+    return decorator
+
+
+def profiled_chunks(name):
+    """function to profile every chunk a generator makes as one stage (a decorator)"""
+    def decorator(function):
+        @wraps(function)
+        def profiled_generator(*args, **kwargs):
+            chunks = function(*args, **kwargs)
+            while True:
+                # The last run only finds out that there are no chunks left
+                with stage(name) as record:
+                    chunk = next(chunks, None)
+                    record['rows_out'] = rows_of(chunk)
+
+                if chunk is None:
+                    return
+                yield chunk
+
+        return profiled_generator
+
+    return decorator
+
+
+def normalize_sentinels(sentinels=NA_SENTINELS):
+    """function to list the NA sentinels once each, in uppercase, as they are compared"""
+    return sorted({sentinel.upper() for sentinel in sentinels})
+
+
+def read_csv_options(sentinels=NA_SENTINELS):
+    """function with the read_csv options shared by every way of reading the csv files"""
+    # The exact sentinels become empty values while the csv file is parsed. Their other
+    #  spellings ("null", "Null", ...) are cleared afterwards by null_sentinels
+    return {
+        'dtype': TRIP_DTYPES,
+        'na_values': list(sentinels),
+    }
+
+
+def null_sentinels(divvy_original, sentinels=NA_SENTINELS):
+    """function to turn the NA sentinels of the string columns into empty values, any case"""
+    # One regex, only run over the (few) categories of the categorical columns, and over
+    #  the ride_ids that are short enough to be a sentinel at all
+    if not sentinels:
+        return divvy_original
+
+    pattern = re.compile('(?i)^(?:' + '|'.join(re.escape(sentinel) for sentinel \
+                                              in normalize_sentinels(sentinels)) + ')$')
+    longest = max(len(sentinel) for sentinel in sentinels)
+
+    for column, dtype in TRIP_DTYPES.items():
+        if column not in divvy_original:
+            continue
+        values = divvy_original[column]
+
+        if dtype == 'category':
+            matched = [category for category in values.cat.categories \
+                       if isinstance(category, str) and pattern.fullmatch(category)]
+            if matched:
+                divvy_original[column] = values.cat.remove_categories(matched)
+        elif dtype.startswith('string'):
+            lengths = values.str.len().to_numpy(dtype=float, na_value=np.inf)
+            candidates = np.flatnonzero(lengths <= longest)
+            matched = [position for position, value in zip(candidates, values.iloc[candidates]) \
+                       if pattern.fullmatch(value)]
+            if matched:
+                values = values.copy()
+                values.iloc[matched] = pd.NA
+                divvy_original[column] = values
+
+    return divvy_original
+
+
+@profiled('read_trips')
+def read_trips(paths, sort='month', sentinels=NA_SENTINELS):
+    """function to read all the monthly csv files at once and combine them (eager mode)"""
+    divvy_months = []
+    for path in paths:
+        with stage('read_csv') as record:
+            divvy_month = null_sentinels(pd.read_csv(path, **read_csv_options(sentinels)), \
+                                         sentinels)
+            record['rows_out'] = len(divvy_month)
+
+        divvy_month = prepare_trips(divvy_month)
+
+        # Every monthly csv file is (nearly) sorted already and the months don't overlap,
+        #  so sorting month by month and combining them in order gives the same result as
+        #  sorting the whole year. Months that are already in order are not sorted at all,
+        #  but a month that isn't costs about as much as sorting it with the whole year
+        if sort == 'month' and not divvy_month['started_at'].is_monotonic_increasing:
+            with stage('sort_trips', len(divvy_month)) as record:
+                divvy_month = divvy_month.sort_values(by='started_at', kind='stable')
+                record['rows_out'] = len(divvy_month)
+
+        divvy_months.append(divvy_month)
+
+    ## Combine the Dataframes and reset the row indices
+    divvy_original = concat_trips(divvy_months)
+
+    ## Sort the dataframe based on "started_at" column ascendingly. The final tables are
+    #  only counts, so sort='none' skips the sorting completely
+    if sort == 'full':
+        with stage('sort_trips', len(divvy_original)) as record:
+            divvy_original = divvy_original.sort_values(by='started_at', ascending=True)
+            record['rows_out'] = len(divvy_original)
+
+    return divvy_original
+
+
+@profiled('concat_trips')
+def concat_trips(divvy_months):
+    """function to combine trips dataframes while keeping the categorical columns"""
+    # pd.concat turns categoricals with different categories into (huge) object
+    #  columns, so let's give every categorical column the same categories first
+    for column in divvy_months[0].columns:
+        if isinstance(divvy_months[0][column].dtype, pd.CategoricalDtype):
+            categories = pd.api.types.union_categoricals([divvy_month[column] for divvy_month \
+                                                          in divvy_months]).categories
+            for divvy_month in divvy_months:
+                divvy_month[column] = divvy_month[column].cat.set_categories(categories)
+
+    return pd.concat(divvy_months, axis=0, ignore_index=True)
+
+
+@profiled_chunks('read_csv')
+def iter_month_chunks(path, chunksize=None, sentinels=NA_SENTINELS):
+    """function to read one monthly csv file, whole (chunksize=None) or in chunks"""
+    if chunksize is None:
+        yield null_sentinels(pd.read_csv(path, **read_csv_options(sentinels)), sentinels)
+        return
+
+    with pd.read_csv(path, chunksize=chunksize, **read_csv_options(sentinels)) as reader:
+        for chunk in reader:
+            yield null_sentinels(chunk, sentinels)
+
 
-# divvy_2022_original.info()
+# %%
+@profiled('prepare_trips')
+def prepare_trips(divvy_original):
+    """function to fix the dtypes and create ride_length, day_of_week, month, and hour"""
+    ## Change the Dtype for started_at and ended_at since they are originally "object"
+    divvy_original['started_at'] = parse_times(divvy_original['started_at'])
+    divvy_original['ended_at'] = parse_times(divvy_original['ended_at'])
+
+    # NOTE: "NULL", "NA", "NaN", and "N/A" strings are already empty values at this point,
+    #  see NA_SENTINELS and null_sentinels above
+
+    ## Create ride_length, which is the difference between ended_at and started_at in seconds,
+    #  day_of_week where Monday is 0 and Sunday is 6, month, and hour (see calendar_columns)
+    for column, values in calendar_columns(divvy_original['started_at'], \
+                                           divvy_original['ended_at']).items():
+        divvy_original[column] = values
+
+    return divvy_original
+
+
+## Calendar Columns - started_at and ended_at are parsed once, and everything else is
+#  derived from their int64 nanoseconds since 1970, instead of a .dt accessor per column
+NS_PER_SECOND = 10 ** 9
+NS_PER_HOUR = 3_600 * NS_PER_SECOND
+NS_PER_DAY = 24 * NS_PER_HOUR
+
+
+def parse_times(values, time_format='%Y-%m-%d %H:%M:%S'):
+    """function to parse a column of "2022-01-01 00:00:00" strings into datetime64[ns]"""
+    # Arrow's ISO 8601 parser is a few times faster than pd.to_datetime. Anything it can't
+    #  parse (or values that are not strings at all) go to pd.to_datetime, which raises
+    #  the usual error for bad values
+    try:
+        parsed = pa.array(np.asarray(values, dtype=object), pa.string(), from_pandas=True) \
+                   .cast(pa.timestamp('ns'))
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pd.to_datetime(values, format=time_format)
+
+    return pd.Series(parsed.to_numpy(zero_copy_only=False), index=values.index, \
+                     name=values.name)
+
+
+def calendar_columns(started_at, ended_at):
+    """function to derive ride_length, day_of_week, month, and hour in one pass"""
+    start = started_at.to_numpy(dtype='datetime64[ns]')
+    end = ended_at.to_numpy(dtype='datetime64[ns]')
+    missing_start = np.isnat(start)
+    start = np.where(missing_start, 0, start.view(np.int64))
+
+    # Same as (ended_at - started_at).dt.total_seconds(), empty if either time is empty
+    ride_length = (end.view(np.int64) - start) / NS_PER_SECOND
+    ride_length[missing_start | np.isnat(end)] = np.nan
+
+    # Floor division, so times before 1970 still get the right day and hour
+    days = start // NS_PER_DAY
+    hours = (start - days * NS_PER_DAY) // NS_PER_HOUR
+
+    # A month of trips only covers ~31 days, so every day gets its month once in a small
+    #  lookup table. The trips without started_at (day 0) don't count for its first and
+    #  last day, so the table doesn't go back to 1970. 1970-01-01 was a Thursday (3)
+    start_days = days[~missing_start]
+    first_day, last_day = (start_days.min(), start_days.max()) if len(start_days) > 0 else (0, 0)
+    days = np.where(missing_start, first_day, days)
+    day_months = pd.DatetimeIndex(np.arange(first_day, last_day + 1).astype('datetime64[D]')) \
+                   .month.to_numpy(dtype=np.int8)
+
+    # Trips without started_at get -1 everywhere, Data Cleaning Part 2 drops them anyway
+    return {
+        'ride_length': ride_length,
+        'day_of_week': np.where(missing_start, -1, (days + 3) % 7).astype(np.int8),
+        'month': np.where(missing_start, -1, day_months[days - first_day]).astype(np.int8),
+        'hour': np.where(missing_start, -1, hours).astype(np.int8),
+    }
 
 
 # %%
-# Just in case, let's convert all "NULL" or "NA" or "NaN" or "N/A"
-#  string values to actually empty values.
-# I don't think they have these string values, but again, just in case.
-divvy_2022_original.replace({
-    '(?i)^NULL$': np.nan, 
-    '(?i)^N/A$': np.nan, 
-    '(?i)^NAN$': np.nan,
-    '(?i)^NA$': np.nan,
-}, regex=True, inplace=True)
+@profiled('clean_trips')
+def clean_trips(divvy_sorted):
+    """function to apply Data Cleaning Part 1, 2, 4, and 5 to a trips dataframe (or a chunk)"""
+    # Every step below only updates one boolean mask of the rows to keep. The rows are
+    #  selected once at the end, instead of copying the dataframe after every step
+
+    ## Data Cleaning Part 1 - ride_length. Divvy Data shows any trips
+    #  that were below 60 seconds in length should be removed
+    keep = (divvy_sorted['ride_length'] >= 60).to_numpy()
+
+    ## Data Cleaning Part 2 - drop rows if we find empty values (just like dropna())
+    keep &= divvy_sorted.notna().all(axis=1).to_numpy()
+
+    ## Data Cleaning Part 4 - data cleaning steps that include the findings from Data
+    #  Cleaning Part 3 (see explore_station_names below).
+    # There are only ~1,400 stations, so let's give the station columns one shared
+    #  dictionary for the names and one for the ids. This way the checks and the
+    #  cleanup below run once per station instead of once per trip
+    start_station_name, end_station_name = shared_categoricals(\
+                                                divvy_sorted['start_station_name'], \
+                                                divvy_sorted['end_station_name'])
+    start_station_id, end_station_id = shared_categoricals(divvy_sorted['start_station_id'], \
+                                                           divvy_sorted['end_station_id'])
+
+    station_names = start_station_name.cat.categories
+    station_ids = start_station_id.cat.categories
+
+    # Findings that need filtering operation include: check_df, check_df_3, and check_df_7.
+    #  The extra False at the end is picked by empty stations (code -1), which are
+    #  already dropped by Part 2
+    is_uppercase = np.append(station_names.str.upper() == station_names, False)
+    is_test_name = np.append(station_names.str.lower().str.contains("test"), False)
+    is_test_id = np.append(station_ids.str.lower().str.contains("test"), False)
+
+    # Map the results of every station back to the trips with the category codes
+    keep &= ~is_uppercase[start_station_name.cat.codes] \
+            & ~is_uppercase[end_station_name.cat.codes] \
+            & ~(is_test_name[start_station_name.cat.codes] \
+                | is_test_name[end_station_name.cat.codes] \
+                | is_test_id[start_station_id.cat.codes] \
+                | is_test_id[end_station_id.cat.codes])
+
+    # Let's remove duplicate ride_id as well
+    keep[keep] = ~divvy_sorted['ride_id'][keep].duplicated().to_numpy()
+
+    rows = np.flatnonzero(keep)
+    divvy_cleaned_4 = divvy_sorted.take(rows)
+
+    # Next, let's delete the unwanted characters and words per our finding,
+    #  "*", "(Temp)", and "- Charging" (see remove_station_suffixes)
+    with stage('remove_station_suffixes', len(divvy_cleaned_4)):
+        divvy_cleaned_4['start_station_name'] = map_categories(start_station_name.take(rows), \
+                                                               remove_station_suffixes)
+        divvy_cleaned_4['end_station_name'] = map_categories(end_station_name.take(rows), \
+                                                             remove_station_suffixes)
+    divvy_cleaned_4['start_station_id'] = start_station_id.take(rows)
+    divvy_cleaned_4['end_station_id'] = end_station_id.take(rows)
+
+    ## Data Cleaning Part 5 - let's eliminate unnecessary white spaces in all columns
+    divvy_cleaned_5 = strip_whitespace(divvy_cleaned_4)
+
+    return divvy_cleaned_5
+
+
+def remove_station_suffixes(names):
+    """function to remove "*", "(Temp)", and "- Charging" from station names"""
+    return names.str.replace('\\*', '', regex=True) \
+                .str.replace('\\(Temp\\)', '', regex=True) \
+                .str.replace('\\ - Charging', '', regex=True)
+
+
+def shared_categoricals(*columns):
+    """function to give several categorical (or string) columns one shared dictionary"""
+    categoricals = [column.astype('category') for column in columns]
+    categories = pd.api.types.union_categoricals(categoricals).categories
+
+    return [categorical.cat.set_categories(categories) for categorical in categoricals]
+
+
+def map_categories(values, function):
+    """function to apply a vectorised string function to the categories of a categorical"""
+    # The function only sees the (few) categories. Categories that end up with the same
+    #  value are merged, e.g. "Foo St (Temp)" and "Foo St" after removing "(Temp)"
+    new_codes, new_categories = pd.factorize(function(values.cat.categories))
+    codes = values.cat.codes.to_numpy()
+    codes = np.where(codes < 0, -1, new_codes[codes])
+
+    return pd.Series(pd.Categorical.from_codes(codes, new_categories), index=values.index, \
+                     name=values.name)
+
+
+@profiled('strip_whitespace')
+def strip_whitespace(dataframe):
+    """function to strip the white spaces of the string columns (in place), column by column"""
+    # Same result as applymap(lambda x: x.strip() if isinstance(x, str) else x), but
+    #  numeric and datetime columns are skipped and string columns use the vectorised
+    #  .str.strip(). Categorical columns only strip their categories. Only object
+    #  columns that mix strings with other values need a function call per value
+    for column in dataframe.columns:
+        if isinstance(dataframe[column].dtype, pd.CategoricalDtype):
+            dataframe[column] = map_categories(dataframe[column], lambda names: names.str.strip())
+        elif isinstance(dataframe[column].dtype, pd.StringDtype):
+            dataframe[column] = dataframe[column].str.strip()
+        elif dataframe[column].dtype == object:
+            if pd.api.types.infer_dtype(dataframe[column], skipna=True) in ('string', 'empty'):
+                dataframe[column] = dataframe[column].str.strip()
+            else:
+                dataframe[column] = dataframe[column].map(lambda x: x.strip() \
+                                                          if isinstance(x, str) else x)
+
+    return dataframe
+
+
+def explore_station_names(divvy_cleaned_2):
+    """function with the Data Cleaning Part 3 investigation (not needed to run the pipeline)"""
+    ## Data Cleaning Part 3 - Before we continue, let's check and investigate potential problems
+
+    # Let's start by checking uppercase or lowercase values from the station
+    #  names to find naming inconsistencies.
+
+    # First, let's just select the column names that we want to check exclusively
+    test_df = divvy_cleaned_2[['ride_id', 'start_station_name', 'end_station_name', \
+                               'start_station_id', 'end_station_id']]
+
+    # Next, let's check the uppercase values from start_station_name
+    check_df = test_df[test_df['start_station_name']. \
+                                      str.upper() == test_df['start_station_name']]
+    # I found something interest. check_df shows rows where start_station_name
+    #  has the value "WEST CHI-WATSON",
+    # and these same rows show start_station_id as "DIVVY 001 - Warehouse test station".
+
+    # let's check further if all start_station_id with "DIVVY" are test stations or not
+    check_df_2 = test_df.query('start_station_id.str.contains("DIVVY") == True')
+    # One row has the value "DIVVY 001" while the other rows have the value
+    #  "DIVVY 001 - Warehouse test station". While it's likely "DIVVY 001"
+    #  is also a test station, let's bypass it for now. Later, let's just clean up the
+    #  rows where the start_station_id has the word "test" , not "DIVVY"
+
+    # Now, let's check the uppercase values from end_station_name
+    check_df_3 = test_df[test_df['end_station_name']. \
+                                      str.upper() == test_df['end_station_name']]
+    # There are several rows with value "DIVVY CASSETTE REPAIR MOBILE STATION",
+    #  which means this is just used for maintenance, not for actual trips.
+    #  This needs to be filtered as well later.
+
+    # Just like check_df2, let's check any end_station_id that contains the word "DIVVY"
+    check_df_4 = test_df.query('end_station_id.str.contains("DIVVY") == True')
+    # Nothing special here, let's move on
+
+    # Now, let's check the lowercase values from both start_station_name and _end_station_name
+    check_df_5 = test_df[test_df['start_station_name']. \
+                                      str.lower() == test_df['start_station_name']]
+
+    check_df_6 = test_df[test_df['end_station_name']. \
+                                      str.lower() == test_df['end_station_name']]
+    # No results for both check_df_5 and check_df_6
+
+    # Now that we know that some rows have the word "test" in
+    #  start_station_id (check check_df), we should check all the station columns
+    #  for the word "test". Let's check regardless of its case
+    check_df_7 = test_df.query('start_station_name.str.lower().str.contains("test") | \
+                                end_station_name.str.lower().str.contains("test") | \
+                                start_station_id.str.lower().str.contains("test") | \
+                                end_station_id.str.lower().str.contains("test")')
+    # there seems to be a lot of test stations here, let's filter them out later
+
+    # After checking check_df_7, I also found out that certain station names ended
+    #  up with "*", "(Temp)", and "- Charging". To avoid unwated analysis during
+    #  the analysis stage later on, these findings should be cleaned as well with str.replace()
+
+    return [check_df, check_df_2, check_df_3, check_df_4, check_df_5, check_df_6, check_df_7]
 
 
 # %%
-## Sort the dataframe based on "started_at" column ascendingly.
-divvy_2022_sorted = divvy_2022_original.sort_values(by='started_at', ascending=True).copy()
+## Cleaned Trips Cache - parsing the csv files, converting the dates, and all the regex
+#  cleanup above take most of the time, so let's keep every cleaned month in a Parquet
+#  file named after a hash of its source csv file. Re-runs only clean months whose
+#  source csv file changed
+def file_fingerprint(path, block_size=1 << 20):
+    """function to hash the content of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()[:16]
+
+
+@profiled_chunks('clean_month')
+def iter_cleaned_month(path, chunksize=None, cache_dir=None, sentinels=NA_SENTINELS):
+    """function to get the cleaned trips and trip points of one monthly csv file, chunk by chunk"""
+    if cache_dir is None:
+        for chunk in iter_month_chunks(path, chunksize, sentinels):
+            divvy_prepared = prepare_trips(chunk)
+            yield clean_trips(divvy_prepared), count_points(divvy_prepared)
+        return
+
+    # The trip points are counted before cleaning (see count_points), so they can't be
+    #  counted from the cleaned trips again. Let's cache them next to the cleaned trips
+    # The NA sentinels change the cleaned trips too, so their hash is part of the file name
+    stem = os.path.splitext(os.path.basename(path))[0]
+    sentinels_hash = hashlib.sha256('\n'.join(normalize_sentinels(sentinels)).encode()) \
+                            .hexdigest()[:8]
+    cached_stem = os.path.join(cache_dir, f"{stem}-{file_fingerprint(path)}-{sentinels_hash}"
+                                          f"-v{CACHE_VERSION}")
+    cached_path, points_path = cached_stem + '.parquet', cached_stem + '.points.npz'
+
+    if os.path.exists(cached_path) and os.path.exists(points_path):
+        with np.load(points_path, allow_pickle=False) as cached_points:
+            points = dense_points(cached_points['cells'], cached_points['counts'])
+
+        # The trip points of the whole month come with the first chunk
+        for divvy_cleaned_5 in iter_cached_month(cached_path, chunksize):
+            yield divvy_cleaned_5, points
+            points = np.zeros(POINT_SHAPE, dtype=np.int64)
+        return
+
+    # Remove cache files of older versions of the same csv file
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale_path in glob.glob(os.path.join(cache_dir, f"{glob.escape(stem)}-*")):
+        os.remove(stale_path)
+
+    # Write to a temporary file first, so an interrupted run never leaves a broken cache file
+    month_points = np.zeros(POINT_SHAPE, dtype=np.int64)
+    with pq.ParquetWriter(cached_path + '.tmp', CLEANED_SCHEMA) as writer:
+        for chunk in iter_month_chunks(path, chunksize, sentinels):
+            divvy_prepared = prepare_trips(chunk)
+            divvy_cleaned_5, points = clean_trips(divvy_prepared), count_points(divvy_prepared)
+            with stage('write_cache', len(divvy_cleaned_5)):
+                writer.write_table(pa.Table.from_pandas(divvy_cleaned_5, schema=CLEANED_SCHEMA, \
+                                                        preserve_index=False))
+            month_points += points
+            yield divvy_cleaned_5, points
+
+    with open(points_path + '.tmp', 'wb') as points_file:
+        cells, counts = sparse_points(month_points)
+        np.savez(points_file, cells=cells, counts=counts)
+    os.replace(points_path + '.tmp', points_path)
+    os.replace(cached_path + '.tmp', cached_path)
+
+
+@profiled_chunks('read_cache')
+def iter_cached_month(cached_path, chunksize=None):
+    """function to read the cleaned trips of one month back from the cache, whole or in chunks"""
+    cached = pq.ParquetFile(cached_path)
+    batches = [cached.read()] if chunksize is None else cached.iter_batches(batch_size=chunksize)
+
+    for batch in batches:
+        # ride_id is an Arrow string again, just like the freshly cleaned trips
+        yield batch.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get)
 
 
 # %%
-## Create ride_length, which is the difference between ended_at and started_at in seconds
-divvy_2022_sorted['ride_length'] = (divvy_2022_sorted['ended_at'] - \
-                                    divvy_2022_sorted['started_at']).dt.total_seconds()
+## Seen Ride Ids - clean_trips only removes the duplicate ride_ids of the trips it gets.
+#  The eager mode gets the whole year at once, but the chunks and months that are cleaned
+#  on their own (streaming, cache, workers, append) also have to drop the ride_ids that
+#  were already counted before them. Those are kept as 64-bit hashes in one sorted array,
+#  8 bytes per trip instead of a Python string (two different ride_ids of ~6 million
+#  trips a year share a hash with a chance of about one in a million)
+def seen_ride_ids(hashes=None):
+    """function to start the (updated in place) ride_ids seen so far, none or some hashes"""
+    return {'hashes': np.empty(0, dtype=np.uint64) if hashes is None \
+                          else np.unique(np.asarray(hashes, dtype=np.uint64))}
 
-## create day_of_week where Monday is 0 and Sunday is 6
-divvy_2022_sorted['day_of_week'] = divvy_2022_sorted['started_at'].dt.weekday
 
+def hash_ride_ids(ride_ids):
+    """function to hash every ride_id into a uint64 (the same one in every process and run)"""
+    return pd.util.hash_array(np.asarray(ride_ids, dtype=object), categorize=False)
 
-# %%
-## Data Cleaning Part 1 - ride_length. Divvy Data shows any trips
-#  that were below 60 seconds in length should be removed
-divvy_2022_cleaned_1 = divvy_2022_sorted.query('ride_length >= 60')
 
-# %%
-## Data Cleaning Part 2 - drop rows if we find empty values by using dropna()
-divvy_2022_cleaned_2 = divvy_2022_cleaned_1.dropna()
+def is_seen(seen, hashes):
+    """function to check which of the hashes are in the seen ride_ids already"""
+    if len(seen['hashes']) == 0:
+        return np.zeros(len(hashes), dtype=bool)
 
-# %%
-## Data Cleaning Part 3 - Before we continue, let's check and investigate potential problems
-
-# Let's start by checking uppercase or lowercase values from the station
-#  names to find naming inconsistencies.
-
-# First, let's just select the column names that we want to check exclusively
-test_df = divvy_2022_cleaned_2[['ride_id', 'start_station_name', 'end_station_name', \
-                                  'start_station_id', 'end_station_id']]
-
-# Next, let's check the uppercase values from start_station_name
-check_df = test_df[test_df['start_station_name']. \
-                                  str.upper() == test_df['start_station_name']]
-# I found something interest. check_df shows rows where start_station_name
-#  has the value "WEST CHI-WATSON",
-# and these same rows show start_station_id as "DIVVY 001 - Warehouse test station".
-
-# let's check further if all start_station_id with "DIVVY" are test stations or not
-check_df_2 = test_df.query('start_station_id.str.contains("DIVVY") == True')
-# One row has the value "DIVVY 001" while the other rows have the value
-#  "DIVVY 001 - Warehouse test station". While it's likely "DIVVY 001"
-#  is also a test station, let's bypass it for now. Later, let's just clean up the
-#  rows where the start_station_id has the word "test" , not "DIVVY"
-
-# Now, let's check the uppercase values from end_station_name
-check_df_3 = test_df[test_df['end_station_name']. \
-                                  str.upper() == test_df['end_station_name']]
-# There are several rows with value "DIVVY CASSETTE REPAIR MOBILE STATION",
-#  which means this is just used for maintenance, not for actual trips.
-#  This needs to be filtered as well later.
-
-# Just like check_df2, let's check any end_station_id that contains the word "DIVVY"
-check_df_4 = test_df.query('end_station_id.str.contains("DIVVY") == True')
-# Nothing special here, let's move on
-
-# Now, let's check the lowercase values from both start_station_name and _end_station_name
-check_df_5 = test_df[test_df['start_station_name']. \
-                                  str.lower() == test_df['start_station_name']]
-
-check_df_6 = test_df[test_df['end_station_name']. \
-                                  str.lower() == test_df['end_station_name']]
-# No results for both check_df_5 and check_df_6
-
-# Now that we know that some rows have the word "test" in
-#  start_station_id (check check_df), we should check all the station columns
-#  for the word "test". Let's check regardless of its case
-check_df_7 = test_df.query('start_station_name.str.lower().str.contains("test") | \
-                            end_station_name.str.lower().str.contains("test") | \
-                            start_station_id.str.lower().str.contains("test") | \
-                            end_station_id.str.lower().str.contains("test")')
-# there seems to be a lot of test stations here, let's filter them out later
-
-# After checking check_df_7, I also found out that certain station names ended
-#  up with "*", "(Temp)", and "- Charging". To avoid unwated analysis during
-#  the analysis stage later on, these findings should be cleaned as well with str.replace()
+    positions = np.searchsorted(seen['hashes'], hashes)
 
+    return seen['hashes'][np.minimum(positions, len(seen['hashes']) - 1)] == hashes
 
-# %%
-## Data Cleaning Part 4 - data cleaning steps that include the findings from Data Cleaning part 3
-#  Findings that need filtering (query) operation include: check_df, check_df_3, and check_df_7
-divvy_2022_cleaned_4 = divvy_2022_cleaned_2.query('start_station_name.str.upper()\
-                                                   != start_station_name') \
-                                            .query('end_station_name.str.upper()\
-                                                    != end_station_name') \
-                                            .query('~(start_station_name.str.lower()\
-                                                   .str.contains("test") | \
-                                                   end_station_name.str.lower()\
-                                                   .str.contains("test") | \
-                                                   start_station_id.str.lower()\
-                                                   .str.contains("test") | \
-                                                   end_station_id.str.lower()\
-                                                   .str.contains("test"))').copy()
-
-# Next, let's delete the unwanted characters and words per our finding,
-#  "*", "(Temp)", and "- Charging"
-divvy_2022_cleaned_4['start_station_name'] = divvy_2022_cleaned_4['start_station_name'] \
-                                                .str.replace('\\*', '', regex=True) \
-                                                .str.replace('\\(Temp\\)', '', regex=True) \
-                                                .str.replace('\\ - Charging', '', regex=True)
 
+def add_seen(seen, hashes):
+    """function to add new (unique, not seen yet) hashes to the seen ride_ids"""
+    # Both arrays are sorted, and a stable sort of two sorted runs is a linear merge
+    seen['hashes'] = np.sort(np.concatenate([seen['hashes'], np.sort(hashes)]), kind='stable')
 
-divvy_2022_cleaned_4['end_station_name'] = divvy_2022_cleaned_4['end_station_name'] \
-                                                .str.replace('\\*', '', regex=True) \
-                                                .str.replace('\\(Temp\\)', '', regex=True) \
-                                                .str.replace('\\ - Charging', '', regex=True)
 
+@profiled('drop_seen_trips')
+def drop_seen_trips(divvy_cleaned_5, seen):
+    """function to drop the cleaned trips with a seen ride_id, and add the others to seen"""
+    # clean_trips already removed the duplicates inside divvy_cleaned_5
+    hashes = hash_ride_ids(divvy_cleaned_5['ride_id'])
+    new = ~is_seen(seen, hashes)
+    add_seen(seen, hashes[new])
 
-# Let's remove duplicate ride_id as well
-divvy_2022_cleaned_4 = divvy_2022_cleaned_4.drop_duplicates(subset='ride_id')
-#Apparently, there are exact same number of rows as before. All good! I keep this
-#  last code line above, just in case
+    return divvy_cleaned_5 if new.all() else divvy_cleaned_5[new]
 
 
 # %%
-## Data Cleaning Part 5 - let's eliminate unnecessary white spaces in all columns
+@profiled('count_trips')
+def count_trips(divvy_cleaned_5, station_index=None):
+    """function to count a cleaned trips dataframe (or chunk) into partial aggregates"""
+    ## Data Analysis Part 1 - every table below is a count over some of the
+    #  member_casual, rideable_type, month, day_of_week, and hour columns. So instead
+    #  of one groupby per table, every trip gets one integer key for its cell of the
+    #  trip cube (see CUBE_AXES), and np.bincount counts all the cells in a single scan
+    member_codes = category_codes(divvy_cleaned_5['member_casual'], CUBE_AXES['member_casual'])
+    rideable_codes = category_codes(divvy_cleaned_5['rideable_type'], CUBE_AXES['rideable_type'])
+    months = divvy_cleaned_5['month'].to_numpy(dtype=np.int64) - 1
+    hours = divvy_cleaned_5['hour'].to_numpy(dtype=np.int64)
+
+    trip_keys = np.ravel_multi_index((
+        member_codes,
+        rideable_codes,
+        months,
+        divvy_cleaned_5['day_of_week'].to_numpy(),
+        hours,
+    ), CUBE_SHAPE)
+
+    cube_size = np.prod(CUBE_SHAPE)
+
+    # The station tables and the trip flows both need the start and end station of every
+    #  trip, so let's look them up only once
+    start_codes, end_codes, station_names = station_codes(divvy_cleaned_5, station_index)
+
+    # Every partial aggregate is a plain count (or sum), so the partials of different
+    #  chunks can simply be added together with merge_counts(). ride_length is in whole
+    #  seconds, so its sum is exact no matter how the trips are split into chunks
+    return {
+        'trips': np.bincount(trip_keys, minlength=cube_size).reshape(CUBE_SHAPE),
+        'ride_length': np.bincount(trip_keys, weights=divvy_cleaned_5['ride_length'], \
+                                   minlength=cube_size).reshape(CUBE_SHAPE),
+        'stations': count_stations(start_codes, end_codes, station_names, member_codes),
+        'flows': sum_flows(station_names, np.ravel_multi_index((member_codes, rideable_codes, \
+                                                                months, hours), FLOW_SHAPE), \
+                           start_codes, end_codes),
+    }
+
+
+def category_codes(values, labels):
+    """function to get the position of every value of a categorical column in labels"""
+    categories = values.cat.categories
+    positions = pd.Index(labels).get_indexer(categories)
+
+    if (positions < 0).any():
+        raise ValueError(f"Unknown {values.name} value(s) {list(categories[positions < 0])}, "
+                         f"please add them to CUBE_AXES['{values.name}']")
+
+    return positions[values.cat.codes]
+
+
+@profiled('station_codes')
+def station_codes(divvy_cleaned_5, station_index=None):
+    """function to get the start and end station code of every trip, and the station names"""
+    # Let's give the start and end stations one shared dictionary, so the same code
+    #  means the same station at both ends of a trip
+    start_station_name, end_station_name = shared_categoricals(\
+                                                divvy_cleaned_5['start_station_name'], \
+                                                divvy_cleaned_5['end_station_name'])
+
+    station_names = start_station_name.cat.categories
+    codes = np.concatenate([start_station_name.cat.codes, end_station_name.cat.codes])
+
+    if station_index is not None:
+        # With a station index, the trips are matched to the nearest known station of their
+        #  start/end coordinates. Only trips without a station nearby keep their station
+        #  name, which is then matched by name with add_station_locations()
+        nearest = np.concatenate([
+            nearest_stations(station_index, divvy_cleaned_5['start_lat'].to_numpy(), \
+                             divvy_cleaned_5['start_lng'].to_numpy()),
+            nearest_stations(station_index, divvy_cleaned_5['end_lat'].to_numpy(), \
+                             divvy_cleaned_5['end_lng'].to_numpy())])
+
+        # One dictionary for the trip station names and the known station names
+        name_codes, station_names = pd.factorize(station_names.append(\
+                                                     pd.Index(station_index['names'])))
+        codes = np.where(nearest >= 0, name_codes[len(name_codes) \
+                             - len(station_index['names']) + nearest], \
+                         name_codes[codes])
+
+    return codes[:len(divvy_cleaned_5)], codes[len(divvy_cleaned_5):], station_names
+
+
+@profiled('count_stations')
+def count_stations(start_codes, end_codes, station_names, member_codes, counts=None):
+    """function to count the trips (or add up counts) that start or end at every station"""
+    # A station counts once for every trip that starts there and once for every trip
+    #  that ends there, and the trips that start there are counted on their own as well
+    #  (see STATION_COUNT_COLUMNS). So let's stack the start, end, and start station codes
+    #  and count all the columns at once, with the station names as index
+    member_codes = np.asarray(member_codes, dtype=np.int64)
+    keys = np.concatenate([start_codes, end_codes, start_codes]).astype(np.int64) \
+               * len(STATION_COUNT_COLUMNS) \
+               + np.concatenate([member_codes, member_codes, member_codes + len(MEMBER_TYPES)])
+    counts = np.bincount(keys, weights=None if counts is None else np.tile(counts, 3), \
+                         minlength=len(station_names) * len(STATION_COUNT_COLUMNS)) \
+               .astype(np.int64)
+
+    station_counts = pd.DataFrame(counts.reshape(-1, len(STATION_COUNT_COLUMNS)), \
+                                  columns=STATION_COUNT_COLUMNS, \
+                                  index=pd.Index(station_names, dtype=object))
+
+    return station_counts[station_counts.sum(axis=1) > 0].sort_index()
+
+
+@profiled('sum_flows')
+def sum_flows(station_names, buckets, start_codes, end_codes, counts=None):
+    """function to add up the trips (or counts) of every bucket, start and end station"""
+    # Only the stations with trips are kept, sorted by name. This way the trip flows
+    #  don't depend on how the trips were split into chunks (or months)
+    station_names = np.asarray(station_names, dtype=object)
+    used = np.unique(np.concatenate([start_codes, end_codes]))
+    names, name_codes = np.unique(station_names[used], return_inverse=True)
+
+    codes = np.zeros(len(station_names), dtype=np.int64)
+    codes[used] = name_codes
+
+    # One sparse key per trip, sorted by bucket first, so all the flows of a member_casual,
+    #  month, and hour are next to each other
+    keys = (np.asarray(buckets, dtype=np.int64) * len(names) + codes[start_codes]) \
+               * len(names) + codes[end_codes]
+    keys, inverse = np.unique(keys, return_inverse=True)
+
+    return {
+        'stations': names,
+        'keys': keys,
+        'counts': np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64),
+    }
+
+
+def split_flow_keys(flows):
+    """function to split the sparse keys of the trip flows into bucket, start and end codes"""
+    stations = len(flows['stations'])
+
+    return flows['keys'] // (stations * stations), flows['keys'] // stations % stations, \
+           flows['keys'] % stations
+
+
+def merge_flows(flows, partial):
+    """function to add up two sets of trip flows, each one with its own station names"""
+    buckets, start_codes, end_codes = split_flow_keys(flows)
+    partial_buckets, partial_start_codes, partial_end_codes = split_flow_keys(partial)
+
+    # The station codes of partial come after the ones of flows, sum_flows takes care
+    #  of the stations that are in both
+    offset = len(flows['stations'])
+
+    return sum_flows(np.concatenate([flows['stations'], partial['stations']]), \
+                     np.concatenate([buckets, partial_buckets]), \
+                     np.concatenate([start_codes, partial_start_codes + offset]), \
+                     np.concatenate([end_codes, partial_end_codes + offset]), \
+                     np.concatenate([flows['counts'], partial['counts']]))
+
+
+@profiled('merge_counts')
+def merge_counts(counts, partial):
+    """function to fold the partial aggregates of one chunk into the running totals"""
+    if counts is None:
+        return partial
+
+    merged = {}
+    for key, value in counts.items():
+        if isinstance(value, np.ndarray):
+            merged[key] = value + partial[key]
+        elif isinstance(value, dict):
+            merged[key] = merge_flows(value, partial[key])
+        else:
+            merged[key] = value.add(partial[key], fill_value=0).astype(np.int64)
+
+    return merged
+
+
+@profiled('count_month')
+def count_month(path, chunksize=None, cache_dir=None, station_index=None, seen=None,
+                sentinels=NA_SENTINELS):
+    """function to read, clean, and count one monthly csv file into partial aggregates"""
+    # The cache keeps the chunks as clean_trips left them, the ride_ids seen in other
+    #  chunks and months are dropped after reading them (see drop_seen_trips)
+    seen = seen_ride_ids() if seen is None else seen
 
-divvy_2022_cleaned_5 = divvy_2022_cleaned_4.copy()
+    counts = None
+    for divvy_cleaned_5, points in iter_cleaned_month(path, chunksize, cache_dir, sentinels):
+        counts = merge_counts(counts, dict(count_trips(drop_seen_trips(divvy_cleaned_5, seen), \
+                                                       station_index), points=points))
+
+    return counts
+
+
+@profiled('count_points')
+def count_points(divvy_prepared):
+    """function to count the start and end points of the trips on the point grid"""
+    # Only Data Cleaning Part 1 applies here, the trips without a station name or id are
+    #  what the grid is for. Empty coordinates and the ones outside the grid aren't counted
+    # The member_casual values are stripped first, like clean_trips does (see strip_whitespace)
+    keep = (divvy_prepared['ride_length'] >= 60).to_numpy() \
+               & divvy_prepared['member_casual'].notna().to_numpy()
+    member_casual = map_categories(divvy_prepared['member_casual'], \
+                                   lambda names: names.str.strip())
+    member_codes = category_codes(member_casual, MEMBER_TYPES)[keep]
 
-divvy_2022_cleaned_5 = divvy_2022_cleaned_5.applymap(lambda x: x.strip() \
-                                                     if isinstance(x, str) else x)
+    point_keys = []
+    for end, prefix in enumerate(POINT_ENDS):
+        rows = np.floor((divvy_prepared[f'{prefix}_lat'].to_numpy(dtype=np.float64)[keep] \
+                         - POINT_ORIGIN[0]) / POINT_STEP[0])
+        columns = np.floor((divvy_prepared[f'{prefix}_lng'].to_numpy(dtype=np.float64)[keep] \
+                            - POINT_ORIGIN[1]) / POINT_STEP[1])
+        inside = (rows >= 0) & (rows < POINT_GRID[0]) & (columns >= 0) \
+                     & (columns < POINT_GRID[1])
 
+        point_keys.append(np.ravel_multi_index((member_codes[inside], end, \
+                                                rows[inside].astype(np.int64), \
+                                                columns[inside].astype(np.int64)), POINT_SHAPE))
 
-# %%
-## Data Analysis Part 1 - New Dataframe for Analysis, New Column(s), and Boolean Masking
+    return np.bincount(np.concatenate(point_keys), minlength=np.prod(POINT_SHAPE)) \
+             .reshape(POINT_SHAPE)
 
-# First of all, let's create a new dataframe, so later we can modify it whenever
-#  needed for analysis purposes
-divvy_2022_analysis_1 = divvy_2022_cleaned_5.copy()
 
-# Let's create the month column for later analysis
-divvy_2022_analysis_1['month'] = pd.to_datetime(divvy_2022_analysis_1['started_at']).dt.month
+def sparse_points(points):
+    """function to get the cells of the point grid with trips, and their counts"""
+    cells = np.flatnonzero(points)
 
-# Let's create the hour column for later analysis
-divvy_2022_analysis_1['hour'] = pd.to_datetime(divvy_2022_analysis_1['started_at']).dt.hour
+    return cells, points.ravel()[cells]
 
-# Boolean Masking for Separating Members and Casuals
-mask_1 = divvy_2022_analysis_1['member_casual'] == 'member'
-mask_2 = divvy_2022_analysis_1['member_casual'] == 'casual'
 
-only_members = divvy_2022_analysis_1[mask_1]
-only_casuals = divvy_2022_analysis_1[mask_2]
+def dense_points(cells, counts):
+    """function to put the counts of sparse_points back on the point grid"""
+    points = np.zeros(np.prod(POINT_SHAPE), dtype=np.int64)
+    points[cells] = counts
 
+    return points.reshape(POINT_SHAPE)
 
-# %%
 
-## Data Analysis Part 2 - Most Popular Station Names for Members
-
-# Count start_station_name total counts
-start_station_name_count_member = only_members.groupby('start_station_name') \
-                                              .size() \
-                                              .reset_index(name='count') \
-                                              .sort_values(by='count', ascending=False)
-
-# Count end_station_name total counts
-end_station_name_count_member = only_members.groupby('end_station_name') \
-                                              .size() \
-                                              .reset_index(name='count') \
-                                              .sort_values(by='count', ascending=False)
-
-# Merge the two DataFrames on the start_station_name and end_station_name columns
-station_name_count_member = pd.merge(start_station_name_count_member,\
-                                      end_station_name_count_member, \
-                                     how='outer', left_on='start_station_name', \
-                                     right_on='end_station_name')
-
-# Combine the total counts from count_x and count_y
-station_name_count_member['count_total'] = np.where(~np.isnan(station_name_count_member\
-                                                              ['count_x']) & \
-                                                    ~np.isnan(station_name_count_member\
-                                                              ['count_y']), \
-                                                        station_name_count_member\
-                                                            ['count_x'] + \
-                                                            station_name_count_member\
-                                                                ['count_y'], \
-                                                            np.where(np.isnan(\
-                                                                station_name_count_member\
-                                                            ['count_y']), station_name_count_member\
-                                                            ['count_x'], station_name_count_member\
-                                                                ['count_y']))
-
-# Let's reorganize it, rename the station name, and delete unnecessary columns
-station_name_count_member = station_name_count_member.rename(columns={\
-                                    'start_station_name': 'station_name'}) \
-                                    .drop(columns=['count_x', 'count_y', 'end_station_name'])
-
-
-#change count_total data type to int
-station_name_count_member['count_total'] = station_name_count_member['count_total'].astype(int)
+# %%
+def count_table(counts):
+    """function to turn a partial count series into a count table sorted by count"""
+    return counts.reset_index(name='count').sort_values(by='count', ascending=False)
+
+
+def cube_counts(cube, keys, **selection):
+    """function to sum the trip cube over every axis except keys, for the selected labels"""
+    # e.g. cube_counts(cube, ['month', 'day_of_week'], member_casual='member') gives the
+    #  same counts as only_members.groupby(['month', 'day_of_week']).size()
+    labels = dict(CUBE_AXES)
+    for axis, label in selection.items():
+        position = list(labels[axis]).index(label)
+        cube = np.take(cube, [position], axis=list(CUBE_AXES).index(axis))
+        labels[axis] = [label]
+
+    other_axes = tuple(position for position, axis in enumerate(CUBE_AXES) if axis not in keys)
+    summed = cube.sum(axis=other_axes)
+
+    # The remaining axes are in CUBE_AXES order, let's put them in the order of keys
+    remaining = [axis for axis in CUBE_AXES if axis in keys]
+    summed = np.transpose(summed, [remaining.index(key) for key in keys])
+
+    counts = pd.Series(summed.ravel(), index=pd.MultiIndex.from_product(\
+                            [labels[key] for key in keys], names=keys))
+
+    # Only the combinations with trips, just like a groupby
+    return counts[counts > 0]
+
+
+def select_labels(axes, **selection):
+    """function to get a boolean array (over all the axes) of the selected labels"""
+    # e.g. select_labels(CUBE_AXES, month=[6, 7, 8]) is True for every cell of the summer
+    #  months. Axes without a selection keep every label
+    selected = np.ones((), dtype=bool)
+    for axis, labels in axes.items():
+        selected = np.logical_and.outer(selected, np.isin(labels, selection[axis]) \
+                                                  if axis in selection \
+                                                  else np.ones(len(labels), dtype=bool))
+
+    return selected
+
+
+def filter_cube(cube, **selection):
+    """function to set every cell of the trip cube outside the selected labels to 0"""
+    # The tables of build_trip_tables() skip the cells without trips, so the tables of a
+    #  filtered cube are the same as the tables of the filtered trips
+    selected = select_labels(CUBE_AXES, **selection)
+
+    return {name: np.where(selected, values, 0) for name, values in cube.items()}
+
+
+def station_name_count(station_counts, member_type):
+    """function to turn the station counts of one member_casual type into a count table"""
+    # Only the stations where this member_casual type starts trips are listed, see
+    #  STATION_COUNT_COLUMNS. Stations are sorted by name, so stations with the same count
+    #  keep that order
+    starts = station_counts[f"{member_type}_start"]
+    return station_counts.loc[starts > 0, member_type].rename_axis('station_name') \
+                                             .reset_index(name='count_total') \
+                                             .sort_values(by='count_total', ascending=False, \
+                                                          kind='stable')
+
+
+def build_trip_tables(cube):
+    """function to build the analysis tables (except the station tables) from the trip cube"""
+    trips = cube['trips']
+
+    ## Data Analysis Part 4 - Most Popular Days and Months
+    # Let's check the most popular days for both members and casuals
+    day_of_week_count = count_table(cube_counts(trips, ['day_of_week', 'member_casual']))
+
+    # Let’s analyze the most popular months and the most popular days for each month
+    popular_month_count_member = count_table(cube_counts(trips, ['month', 'day_of_week'], \
+                                                         member_casual='member'))
+    popular_month_count_casual = count_table(cube_counts(trips, ['month', 'day_of_week'], \
+                                                         member_casual='casual'))
+
+    ## Data Analysis Part 5 - Most Popular Hours (grouped by hour and member_casual)
+    popular_hours_count = count_table(cube_counts(trips, ['hour', 'member_casual']))
+
+    ## Data Analysis Part 6 - Analyze Ride Length Difference Between Casuals and Members
+    ride_length_rows = cube_counts(trips, ['member_casual'])
+    ride_length_sum = cube_counts(cube['ride_length'], ['member_casual'])
+    ride_length_avg = (ride_length_sum[ride_length_rows.index] / ride_length_rows / 60) \
+                            .rename('avg_ride_length_in_minutes') \
+                            .reset_index()
+
+    ## Data Analysis Part 7 - Bike Types Analysis - Members & Casuals
+    rideable_type_count_member = count_table(cube_counts(trips, ['rideable_type', \
+                                            'member_casual'], member_casual='member'))
+    rideable_type_count_casual = count_table(cube_counts(trips, ['rideable_type', \
+                                            'member_casual'], member_casual='casual'))
+
+    return {
+        'day_of_week_count': day_of_week_count,
+        'popular_month_count_member': popular_month_count_member,
+        'popular_month_count_casual': popular_month_count_casual,
+        'popular_hours_count': popular_hours_count,
+        'ride_length_avg': ride_length_avg,
+        'rideable_type_count_member': rideable_type_count_member,
+        'rideable_type_count_casual': rideable_type_count_casual,
+    }
 
 
 # %%
-## Data Analysis Part 3 - Most Popular Station Names for Casuals
-
-# Count start_station_name total counts
-start_station_name_count_casual = only_casuals.groupby('start_station_name') \
-                                              .size() \
-                                              .reset_index(name='count') \
-                                              .sort_values(by='count', ascending=False)
-
-# Count end_station_name total counts
-end_station_name_count_casual = only_casuals.groupby('end_station_name') \
-                                            .size() \
-                                            .reset_index(name='count') \
-                                            .sort_values(by='count', ascending=False)
-
-# Merge the two DataFrames on the start_station_name and end_station_name columns
-station_name_count_casual = pd.merge(start_station_name_count_casual,\
-                                      end_station_name_count_casual, \
-                                     how='outer', left_on='start_station_name', \
-                                     right_on='end_station_name')
-
-# Combine the total counts from count_x and count_y
-station_name_count_casual['count_total'] = np.where(~np.isnan(\
-                                station_name_count_casual['count_x']) & \
-                                ~np.isnan(station_name_count_casual['count_y']), \
-                                station_name_count_casual['count_x'] + \
-                                station_name_count_casual['count_y'], \
-                                np.where(np.isnan(station_name_count_casual\
-                                ['count_y']), station_name_count_casual\
-                                ['count_x'], station_name_count_casual['count_y']))
-
-# Let's reorganize it, rename the station name, and delete unnecessary columns
-station_name_count_casual = station_name_count_casual.rename(\
-                                columns={'start_station_name': 'station_name'}) \
-                                .drop(columns=['count_x', 'count_y', 'end_station_name'])
-
-#change count_total data type to int
-station_name_count_casual['count_total'] = station_name_count_casual['count_total'].astype(int)
+## For Map Visualization of the Station Names (Part 2 and Part 3 Above),
+#  we need to get the latitude and longitude
+@profiled('read_bicycle_stations')
+def read_bicycle_stations(path="divvy_bicycle_stations.csv"):
+    """function to read and clean the station locations csv"""
+    # Get the .csv file from here: https://data.cityofchicago.org
+    divvy_bicycle_stations = pd.read_csv(path)
+
+    # Let's clean up the station names, just like before, but for the new csv file
+    divvy_bicycle_stations['Station Name'] = divvy_bicycle_stations['Station Name'] \
+                                                .str.replace('\\*', '', regex=True) \
+                                                .str.replace('\\(Temp\\)', '', regex=True) \
+                                                .str.replace('\\ - Charging', '', regex=True)
 
-# %%
-## Data Analysis Part 4 - Most Popular Days and Months
+    divvy_bicycle_stations = strip_whitespace(divvy_bicycle_stations)
+
+    return divvy_bicycle_stations
 
-# Let's check the most popular days for both members and casuals
-day_of_week_count = divvy_2022_analysis_1.groupby(['day_of_week', 'member_casual']) \
-                                            .size() \
-                                            .reset_index(name='count') \
-                                            .sort_values(by='count', ascending=False)
 
+def add_station_locations(station_name_count, divvy_bicycle_stations):
+    """function to merge the latitude and longitude data with a station_name_count table"""
+    station_name_count_w_location_pre_cleaned = pd.merge(station_name_count, \
+                                                         divvy_bicycle_stations, \
+                                                how='left', left_on='station_name', \
+                                                    right_on='Station Name')\
+                                                    .drop(columns=['Station Name',\
+                                                                    'Total Docks', \
+                                                                   'Docks in Service',\
+                                                                      'Status', 'ID'])
 
-# Let’s analyze the most popular months and the most popular days for each month (members only)
-popular_month_count_member = only_members.groupby(['month', 'day_of_week']) \
-                                              .size() \
-                                              .reset_index(name='count') \
-                                              .sort_values(by='count', ascending=False)
+    # NOTE: You can fill missing latitude and longitude data manually if you want to
 
-# Let’s analyze the most popular months and the most popular days for each month (casuals only)
-popular_month_count_casual = only_casuals.groupby(['month', 'day_of_week']) \
-                                              .size() \
-                                              .reset_index(name='count') \
-                                              .sort_values(by='count', ascending=False)
+    # Let's delete rows with empty locations
+    return station_name_count_w_location_pre_cleaned.dropna(subset=['Location'])
 
 
 # %%
+## Station Index - matching trips to stations by name loses every station whose name is
+#  slightly different in divvy_bicycle_stations.csv. The trips have coordinates too, so
+#  let's match them to the nearest station instead. The stations are put in a grid of
+#  radius-sized cells, so every trip only has to be compared with the stations of its
+#  own cell and the 8 cells around it
+METERS_PER_DEGREE = 111_320
 
-## Data Analysis Part 5 - Most Popular Hours
 
-# Let's analyze the most popular hours (grouped by hour and member_casual)
-popular_hours_count = divvy_2022_analysis_1.groupby(['hour', 'member_casual']) \
-                                              .size() \
-                                              .reset_index(name='count') \
-                                              .sort_values(by='count', ascending=False)
+def project_meters(index, latitude, longitude):
+    """function to convert coordinates into meters from the center of the station index"""
+    x = (np.asarray(longitude, dtype=np.float64) - index['center'][1]) * METERS_PER_DEGREE \
+            * np.cos(np.radians(index['center'][0]))
+    y = (np.asarray(latitude, dtype=np.float64) - index['center'][0]) * METERS_PER_DEGREE
 
+    return x, y
 
-# %%
 
-## Data Analysis Part 6 - Analyze Ride Length Difference Between Casuals and Members
-ride_length_avg = divvy_2022_analysis_1.assign(ride_length_in_minutes=\
-                                               divvy_2022_analysis_1['ride_length'] / 60) \
-                                        .groupby('member_casual') \
-                                        .agg(avg_ride_length_in_minutes=(\
-                                            'ride_length_in_minutes', 'mean')) \
-                                        .reset_index()
+def grid_cells(index, x, y):
+    """function to get the grid cell column and row of every point"""
+    return np.floor(x / index['radius']).astype(np.int64) - index['origin'][0], \
+           np.floor(y / index['radius']).astype(np.int64) - index['origin'][1]
 
 
-# %%
+@profiled('build_station_index')
+def build_station_index(divvy_bicycle_stations, radius=STATION_RADIUS):
+    """function to build the grid index of the station coordinates"""
+    stations = divvy_bicycle_stations.dropna(subset=['Latitude', 'Longitude'])
 
-## Data Analysis Part 7 - Bike Types Analysis - Members & Casuals
+    index = {
+        'names': stations['Station Name'].to_numpy(dtype=object),
+        'center': (stations['Latitude'].mean(), stations['Longitude'].mean()),
+        'radius': radius,
+    }
+    index['x'], index['y'] = project_meters(index, stations['Latitude'], stations['Longitude'])
 
-rideable_type_count_member = (only_members.groupby(['rideable_type', 'member_casual']) \
-                       .size().reset_index(name='count').sort_values(by='count', ascending=False))
+    # The grid covers the stations (a few hundred thousand cells for Chicago), and
+    #  cell_start/cell_count say where the stations of every cell are in order
+    index['origin'] = (np.floor(index['x'] / radius).astype(np.int64).min(initial=0),
+                       np.floor(index['y'] / radius).astype(np.int64).min(initial=0))
+    columns, rows = grid_cells(index, index['x'], index['y'])
+    index['shape'] = (columns.max(initial=0) + 1, rows.max(initial=0) + 1)
 
-rideable_type_count_casual = (only_casuals.groupby(['rideable_type', 'member_casual']) \
-                           .size().reset_index(name='count')\
-                            .sort_values(by='count', ascending=False))
+    cells = columns * index['shape'][1] + rows
+    index['order'] = np.argsort(cells, kind='stable')
+    index['cell_count'] = np.bincount(cells, minlength=np.prod(index['shape']))
+    index['cell_start'] = np.cumsum(index['cell_count']) - index['cell_count']
+    index['cell_size'] = index['cell_count'].max(initial=0)
 
+    return index
 
-# %%
 
-## For Map Visualization of the Station Names (Part 2 and Part 3 Above),
-#  we need to get the latitude and longitude
+@profiled('nearest_stations')
+def nearest_stations(index, latitude, longitude):
+    """function to find the position of the nearest station within radius (-1 if none)"""
+    x, y = project_meters(index, latitude, longitude)
+    columns, rows = grid_cells(index, x, y)
 
-# Get the .csv file from here: https://data.cityofchicago.org
-divvy_bicycle_stations = pd.read_csv("divvy_bicycle_stations.csv")
+    nearest = np.full(len(x), -1, dtype=np.int64)
+    nearest_distance = np.full(len(x), index['radius'] ** 2, dtype=np.float64)
 
-# Let's clean up the station names, just like before, but for the new csv file
-divvy_bicycle_stations['Station Name'] = divvy_bicycle_stations['Station Name'] \
-                                                .str.replace('\\*', '', regex=True) \
-                                                .str.replace('\\(Temp\\)', '', regex=True) \
-                                                .str.replace('\\ - Charging', '', regex=True)
+    # A station within radius is always in the cell of the trip or one of the 8 cells
+    #  around it. Every cell has at most cell_size stations, so a few vectorised passes
+    #  over the trips compare them with every candidate station
+    for offset_column in (-1, 0, 1):
+        for offset_row in (-1, 0, 1):
+            column, row = columns + offset_column, rows + offset_row
+            trips = np.flatnonzero((column >= 0) & (column < index['shape'][0]) \
+                                   & (row >= 0) & (row < index['shape'][1]))
+
+            cells = column[trips] * index['shape'][1] + row[trips]
+            cell_count = index['cell_count'][cells]
+
+            # Most cells have no station at all
+            trips, cells, cell_count = trips[cell_count > 0], cells[cell_count > 0], \
+                                       cell_count[cell_count > 0]
+            cell_start = index['cell_start'][cells]
+
+            for candidate in range(index['cell_size']):
+                has_candidate = cell_count > candidate
+                candidate_trips = trips[has_candidate]
+                stations = index['order'][cell_start[has_candidate] + candidate]
 
-divvy_bicycle_stations = divvy_bicycle_stations.applymap(lambda x: x.strip() \
-                                                     if isinstance(x, str) else x)
+                distance = (x[candidate_trips] - index['x'][stations]) ** 2 \
+                           + (y[candidate_trips] - index['y'][stations]) ** 2
+                closer = distance <= nearest_distance[candidate_trips]
+
+                nearest[candidate_trips[closer]] = stations[closer]
+                nearest_distance[candidate_trips[closer]] = distance[closer]
+
+    return nearest
 
 # %%
+def count_files(paths, streaming=False, chunksize=CHUNK_SIZE, cache_dir=None, workers=1,
+                sort='month', station_index=None, backend='pandas', memory_limit=None,
+                seen=None, sentinels=NA_SENTINELS):
+    """function to read, clean, and count the csv files into (merged) partial aggregates"""
+    # Trips with a ride_id in seen are not counted, and the ride_ids of the counted
+    #  trips are added to it (see drop_seen_trips)
+    seen = seen_ride_ids() if seen is None else seen
+
+    if backend == 'duckdb':
+        return count_files_duckdb(paths, station_index, threads=workers if workers > 1 else None,
+                                  memory_limit=memory_limit, batch_size=chunksize, seen=seen,
+                                  sentinels=sentinels)
+
+    if streaming or cache_dir is not None or workers > 1:
+        # Streaming mode - clean and count one chunk at a time, only the (small)
+        #  partial aggregates and the seen ride_ids are kept in memory. With a cache
+        #  folder or several workers, every month is cleaned (or loaded from the cache)
+        #  and counted on its own
+        month_counts = iter_month_counts(paths, chunksize if streaming else None, cache_dir, \
+                                         workers, station_index, seen, sentinels)
+
+        return reduce(merge_counts, (counts for _, counts in month_counts), None)
+
+    divvy_sorted = read_trips(paths, sort, sentinels)
+
+    return dict(count_trips(drop_seen_trips(clean_trips(divvy_sorted), seen), station_index), \
+                points=count_points(divvy_sorted))
+
+
+def iter_month_counts(paths, chunksize=None, cache_dir=None, workers=1, station_index=None,
+                      seen=None, sentinels=NA_SENTINELS):
+    """function to count every csv file on its own, and get their partial aggregates in order"""
+    seen = seen_ride_ids() if seen is None else seen
+
+    if workers <= 1:
+        for path in paths:
+            yield path, count_month(path, chunksize, cache_dir, station_index, seen, sentinels)
+        return
+
+    # Every month is independent until the final tables, so let's count them in separate
+    #  processes, each one with the ride_ids of its own month only. The partial aggregates
+    #  come back in month order, just like the serial path. A month that shares ride_ids
+    #  with the months before it is counted again here, with the seen ride_ids of those
+    #  months, so the results are exactly the same
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, (month_counts, month_hashes, records) in zip(paths, \
+                executor.map(count_month_apart, paths, repeat(chunksize), repeat(cache_dir), \
+                             repeat(station_index), repeat(sentinels), \
+                             repeat(STAGE_PROFILE['records'] is not None), \
+                             repeat(STAGE_PROFILE['memory']))):
+            # The stages of every month are profiled in its worker process, and their
+            #  records come back together with the partial aggregates
+            if STAGE_PROFILE['records'] is not None:
+                STAGE_PROFILE['records'].extend(records)
+
+            if is_seen(seen, month_hashes).any():
+                month_counts = count_month(path, chunksize, cache_dir, station_index, seen, \
+                                           sentinels)
+            else:
+                add_seen(seen, month_hashes)
+
+            yield path, month_counts
+
+
+def count_month_apart(path, chunksize=None, cache_dir=None, station_index=None,
+                      sentinels=NA_SENTINELS, profile=False, memory=False):
+    """function to count one month in a worker process, with its ride_ids (and stage records)"""
+    if profile:
+        start_profile(memory)
+
+    seen = seen_ride_ids()
+    try:
+        counts = count_month(path, chunksize, cache_dir, station_index, seen, sentinels)
+    finally:
+        records = stop_profile()['records'] if profile else []
+
+    return counts, seen['hashes'], records
+
 
-## Merge the latitude and longitude data with our station_name_count_member
-#  and station_name_count_casual
-station_name_count_member_w_location_pre_cleaned  = pd.merge(station_name_count_member,\
-                                                              divvy_bicycle_stations, \
-                                                    how='left', left_on='station_name', \
-                                                        right_on='Station Name')\
-                                                        .drop(columns=['Station Name',\
-                                                                        'Total Docks', \
-                                                                       'Docks in Service',\
-                                                                          'Status', 'ID'])
-
-station_name_count_casual_w_location_pre_cleaned  = pd.merge(station_name_count_casual,\
-                                                              divvy_bicycle_stations, \
-                                                    how='left', left_on='station_name', \
-                                                        right_on='Station Name')\
-                                                        .drop(columns=['Station Name',\
-                                                                        'Total Docks', \
-                                                                       'Docks in Service',\
-                                                                          'Status', 'ID'])
-
-# NOTE: You can fill missing latitude and longitude data manually if you want to
-
-# Let's delete rows with empty locations
-station_name_count_member_w_location = station_name_count_member_w_location_pre_cleaned\
-                                 .dropna(subset=['Location'])
-station_name_count_casual_w_location = station_name_count_casual_w_location_pre_cleaned\
-                                 .dropna(subset=['Location'])
+# %%
+## DuckDB Backend - the same Data Import, Data Cleaning Part 1, 2, 4, and 5, and Data
+#  Analysis Part 1 steps as one lazy query plan, run by an embedded DuckDB database.
+#  DuckDB reads the csv files in parallel, pushes the filters down into the scan, and
+#  spills to DUCKDB_TEMP_DIR when the trips don't fit in memory_limit, so no cleaned
+#  dataframe is ever built. Only the trips grouped by their cube cell and their stations
+#  come back, and go through the same count functions as the pandas backend
+def sql_string(value):
+    """function to quote a Python string as an SQL string literal"""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def duckdb_trips_sql(sentinels=NA_SENTINELS):
+    """function with the SQL of the prepared trips of the csv files ($paths), like prepare_trips"""
+    # Every value read_trips reads as an empty value is NULL here too: the exact NA sentinels
+    #  and the default NA values of pd.read_csv while reading, and the other spellings of the
+    #  sentinels in the string columns afterwards (like null_sentinels). Timestamps are parsed
+    #  while reading, and the coordinates are rounded to float32 like TRIP_DTYPES
+    null_values = ', '.join(sql_string(value) for value \
+                            in sorted(set(sentinels) | set(DEFAULT_NA_VALUES)))
+    upper_sentinels = ', '.join(sql_string(sentinel) for sentinel \
+                                in normalize_sentinels(sentinels))
+    strings = {column: f"CASE WHEN upper({column}) IN ({upper_sentinels}) THEN NULL "
+                       f"ELSE {column} END AS {column}" if upper_sentinels else column \
+               for column in ('ride_id', 'rideable_type', *STATION_COLUMNS, 'member_casual')}
+    types = ', '.join(f"{sql_string(column)}: {sql_type}" for column, sql_type in ( \
+                          [(column, 'VARCHAR') for column in ('ride_id', 'rideable_type', \
+                                                              'member_casual')] \
+                          + [(column, 'VARCHAR') for column in STATION_COLUMNS] \
+                          + [(column, 'TIMESTAMP') for column in ('started_at', 'ended_at')] \
+                          + [(f"{prefix}_{axis}", 'DOUBLE') for prefix in POINT_ENDS \
+                             for axis in ('lat', 'lng')]))
+
+    return f"""
+        SELECT {strings['ride_id']}, {strings['rideable_type']}, started_at, ended_at,
+               {', '.join(strings[column] for column in STATION_COLUMNS)},
+               CAST(start_lat AS FLOAT) AS start_lat, CAST(start_lng AS FLOAT) AS start_lng,
+               CAST(end_lat AS FLOAT) AS end_lat, CAST(end_lng AS FLOAT) AS end_lng,
+               {strings['member_casual']},
+               CAST(date_diff('second', started_at, ended_at) AS DOUBLE) AS ride_length,
+               isodow(started_at) - 1 AS day_of_week,
+               list_position($paths, filename) AS file_position
+        FROM read_csv($paths, header = true, union_by_name = true, filename = true,
+                      types = {{{types}}}, timestampformat = '%Y-%m-%d %H:%M:%S',
+                      nullstr = [{null_values}])"""
+
+
+def duckdb_cleaned_sql(sentinels=NA_SENTINELS):
+    """function with the SQL of the cleaned trips, with the columns that are counted"""
+    # Data Cleaning Part 1, 2, and 4 (without the station name cleanup). The station names
+    #  are cleaned up by count_trip_groups, once per station instead of once per trip
+    not_null = ' AND '.join(f"{column} IS NOT NULL" for column in ( \
+                                'ride_id', 'rideable_type', 'started_at', 'ended_at', \
+                                *STATION_COLUMNS, 'start_lat', 'start_lng', 'end_lat', \
+                                'end_lng', 'member_casual', 'ride_length'))
+    no_test = ' OR '.join(f"contains(lower({column}), 'test')" for column in STATION_COLUMNS)
+
+    # Duplicate ride_ids keep their first trip in the order of read_trips: month by
+    #  month, sorted by started_at (trips with the same ride_id and started_at in the
+    #  same month are told apart by the rest of their columns)
+    return f"""
+        WITH trips AS ({duckdb_trips_sql(sentinels)})
+        SELECT ride_id, member_casual, rideable_type, month(started_at) AS month, day_of_week,
+               hour(started_at) AS hour, start_station_name, start_lat, start_lng,
+               end_station_name, end_lat, end_lng, ride_length
+        FROM trips
+        WHERE ride_length >= 60 AND {not_null}
+          AND upper(start_station_name) <> start_station_name
+          AND upper(end_station_name) <> end_station_name
+          AND NOT ({no_test})
+        QUALIFY row_number() OVER (PARTITION BY ride_id ORDER BY file_position, started_at,
+                                   ended_at, {', '.join(STATION_COLUMNS)}, start_lat,
+                                   start_lng, end_lat, end_lng, rideable_type,
+                                   member_casual) = 1"""
+
+
+def duckdb_groups_sql(seen_table=None, coordinates=True):
+    """function with the SQL of the trips of table cleaned, grouped by cube cell and stations"""
+    # The trips with a ride_id that was counted before (see drop_seen_trips) are left out
+    not_seen = '' if seen_table is None else \
+                   f"WHERE ride_id NOT IN (SELECT ride_id FROM {seen_table})"
+
+    # The coordinates are only needed to match the trips to the nearest station (see
+    #  station_codes). Without a station index, the stations are matched by name only,
+    #  and grouping by name gives far fewer groups than by name and coordinates
+    stations = "start_station_name, start_lat, start_lng, end_station_name, end_lat, end_lng" \
+                   if coordinates else "start_station_name, end_station_name"
+
+    return f"""
+        SELECT member_casual, rideable_type, month, day_of_week, hour, {stations},
+               count(*) AS trips, sum(ride_length) AS ride_length
+        FROM cleaned {not_seen}
+        GROUP BY ALL"""
+
+
+def duckdb_points_sql(sentinels=NA_SENTINELS):
+    """function with the SQL of the trip points grouped by grid cell, like count_points"""
+    ends = ' UNION ALL '.join(f"""
+        SELECT member_casual, {end} AS point_end,
+               floor((CAST({prefix}_lat AS DOUBLE) - {POINT_ORIGIN[0]!r}::DOUBLE)
+                     / {POINT_STEP[0]!r}::DOUBLE) AS point_row,
+               floor((CAST({prefix}_lng AS DOUBLE) - {POINT_ORIGIN[1]!r}::DOUBLE)
+                     / {POINT_STEP[1]!r}::DOUBLE) AS point_column
+        FROM trips WHERE ride_length >= 60 AND member_casual IS NOT NULL""" \
+                              for end, prefix in enumerate(POINT_ENDS))
+
+    return f"""
+        WITH trips AS ({duckdb_trips_sql(sentinels)}),
+        points AS ({ends})
+        SELECT member_casual, point_end, CAST(point_row AS BIGINT) AS point_row,
+               CAST(point_column AS BIGINT) AS point_column, count(*) AS trips
+        FROM points
+        WHERE point_row >= 0 AND point_row < {POINT_GRID[0]}
+          AND point_column >= 0 AND point_column < {POINT_GRID[1]}
+        GROUP BY ALL"""
+
+
+def count_trip_groups(groups, station_index=None):
+    """function to count the grouped cleaned trips of DuckDB into partial aggregates"""
+    # Data Cleaning Part 4 (the station names) and 5, on the categories only
+    groups = groups.astype({column: 'category' for column in ('member_casual', \
+                                'rideable_type', 'start_station_name', 'end_station_name')})
+    for column in ('start_station_name', 'end_station_name'):
+        groups[column] = map_categories(groups[column], remove_station_suffixes)
+    groups = strip_whitespace(groups)
+
+    # Same as count_trips, but every row is a group of trips with the same cube cell and
+    #  stations, so the counts are added up instead of counted
+    member_codes = category_codes(groups['member_casual'], CUBE_AXES['member_casual'])
+    rideable_codes = category_codes(groups['rideable_type'], CUBE_AXES['rideable_type'])
+    months = groups['month'].to_numpy(dtype=np.int64) - 1
+    hours = groups['hour'].to_numpy(dtype=np.int64)
+    trips = groups['trips'].to_numpy(dtype=np.int64)
+
+    trip_keys = np.ravel_multi_index((member_codes, rideable_codes, months, \
+                                      groups['day_of_week'].to_numpy(dtype=np.int64), hours), \
+                                     CUBE_SHAPE)
+    cube_size = np.prod(CUBE_SHAPE)
+
+    start_codes, end_codes, station_names = station_codes(groups, station_index)
+
+    return {
+        'trips': np.bincount(trip_keys, weights=trips, minlength=cube_size) \
+                     .astype(np.int64).reshape(CUBE_SHAPE),
+        'ride_length': np.bincount(trip_keys, weights=groups['ride_length'], \
+                                   minlength=cube_size).reshape(CUBE_SHAPE),
+        'stations': count_stations(start_codes, end_codes, station_names, member_codes, trips),
+        'flows': sum_flows(station_names, np.ravel_multi_index((member_codes, rideable_codes, \
+                                                                months, hours), FLOW_SHAPE), \
+                           start_codes, end_codes, trips),
+    }
+
+
+def count_point_groups(groups):
+    """function to put the grouped trip points of DuckDB on the point grid"""
+    member_casual = map_categories(groups['member_casual'].astype('category'), \
+                                   lambda names: names.str.strip())
+    member_codes = category_codes(member_casual, MEMBER_TYPES)
+    point_keys = np.ravel_multi_index((member_codes, groups['point_end'].to_numpy(), \
+                                       groups['point_row'].to_numpy(), \
+                                       groups['point_column'].to_numpy()), POINT_SHAPE)
+
+    return np.bincount(point_keys, weights=groups['trips'], minlength=np.prod(POINT_SHAPE)) \
+             .astype(np.int64).reshape(POINT_SHAPE)
+
+
+@profiled('count_duckdb')
+def count_files_duckdb(paths, station_index=None, threads=None, memory_limit=None,
+                       batch_size=CHUNK_SIZE, temp_dir=DUCKDB_TEMP_DIR, seen=None,
+                       sentinels=NA_SENTINELS):
+    """function to read, clean, and count the csv files with DuckDB (the duckdb backend)"""
+    # DuckDB is only needed for this backend
+    import duckdb
+
+    seen = seen_ride_ids() if seen is None else seen
+
+    connection = duckdb.connect()
+    connection.execute(f"SET temp_directory = {sql_string(temp_dir)}")
+    if threads is not None:
+        connection.execute(f"SET threads = {int(threads)}")
+    if memory_limit is not None:
+        connection.execute(f"SET memory_limit = {sql_string(memory_limit)}")
+
+    parameters = {'paths': [str(path) for path in paths]}
+
+    try:
+        with stage('points') as record:
+            point_groups = connection.execute(duckdb_points_sql(sentinels), parameters).df()
+            record['rows_out'] = len(point_groups)
+            points = count_point_groups(point_groups)
+
+        # The cleaned trips are kept in a table (spilled to temp_dir if they don't fit),
+        #  so their ride_ids can be checked against the seen ones before they are grouped
+        with stage('clean') as record:
+            connection.execute(f"CREATE TEMP TABLE cleaned AS {duckdb_cleaned_sql(sentinels)}", \
+                               parameters)
+            record['rows_out'] = connection.execute("SELECT count(*) FROM cleaned").fetchone()[0]
+
+        # The ride_ids in cleaned are unique already, so the new ones are added at the end
+        with stage('seen_ride_ids'):
+            new_hashes, seen_trips = [np.empty(0, dtype=np.uint64)], []
+            for batch in connection.execute("SELECT ride_id FROM cleaned") \
+                                   .to_arrow_reader(batch_size):
+                ride_ids = batch.column(0).to_numpy(zero_copy_only=False)
+                hashes = hash_ride_ids(ride_ids)
+                found = is_seen(seen, hashes)
+                new_hashes.append(hashes[~found])
+                seen_trips.append(ride_ids[found])
+            add_seen(seen, np.concatenate(new_hashes))
+
+        seen_table = None
+        if sum(len(ride_ids) for ride_ids in seen_trips) > 0:
+            connection.register('seen_trips', pa.table({'ride_id': pa.array(\
+                                    np.concatenate(seen_trips), pa.string())}))
+            seen_table = 'seen_trips'
+
+        # The groups come back in batches, so they never have to fit in memory at once
+        with stage('trips') as record:
+            reader = connection.execute(duckdb_groups_sql(seen_table, \
+                                                          station_index is not None)) \
+                               .to_arrow_reader(batch_size)
+            counts = None
+            for batch in reader:
+                counts = merge_counts(counts, count_trip_groups(batch.to_pandas(), \
+                                                                station_index))
+            if counts is None:
+                counts = count_trip_groups(reader.schema.empty_table().to_pandas(), \
+                                           station_index)
+            record['rows_out'] = int(counts['trips'].sum())
+    finally:
+        connection.close()
+
+    return dict(counts, points=points)
+
+
+@profiled('build_outputs')
+def build_outputs(counts, divvy_bicycle_stations):
+    """function to build the station tables, with station locations, from the partial aggregates"""
+    ## Data Analysis Part 2 and 3 - Most Popular Station Names for Members and Casuals
+    #  (the other tables are built by app.py from the trip cube, see build_trip_tables)
+    return {
+        'station_name_count_member_w_location': add_station_locations(\
+                station_name_count(counts['stations'], 'member'), divvy_bicycle_stations),
+        'station_name_count_casual_w_location': add_station_locations(\
+                station_name_count(counts['stations'], 'casual'), divvy_bicycle_stations),
+    }
 
 
 # %%
+## Pipeline State - the Pickle files only hold the final values (e.g. averages), so
+#  they can't be updated with a new month. The merged partial aggregates (counts and
+#  ride_length sums) can, so let's save them, together with the csv files they came from
+#  and the ride_ids that were counted (so appended months drop them as duplicates)
+@profiled('save_state')
+def save_state(counts, months, seen, path=STATE_PATH, sentinels=NA_SENTINELS,
+               station_index=None):
+    """function to save the partial aggregates, the seen ride_ids, and the months they came from"""
+    # Only the cells of the point grid with trips are saved
+    point_cells, point_counts = sparse_points(counts['points'])
+
+    # Write to a temporary file first, so an interrupted run never leaves a broken state
+    with open(path + '.tmp', 'wb') as state_file:
+        np.savez(state_file,
+                 trips=counts['trips'],
+                 ride_length=counts['ride_length'],
+                 station_names=np.array(counts['stations'].index, dtype=str),
+                 station_counts=counts['stations'].to_numpy(),
+                 flow_shape=FLOW_SHAPE,
+                 flow_stations=np.array(counts['flows']['stations'], dtype=str),
+                 flow_keys=counts['flows']['keys'],
+                 flow_counts=counts['flows']['counts'],
+                 point_shape=POINT_SHAPE,
+                 point_grid=POINT_ORIGIN + POINT_STEP,
+                 point_cells=point_cells,
+                 point_counts=point_counts,
+                 ride_ids=seen['hashes'],
+                 na_sentinels=np.array(normalize_sentinels(sentinels), dtype=str),
+                 station_radius=state_station_radius(station_index),
+                 month_files=np.array([name for name, _ in months], dtype=str),
+                 month_fingerprints=np.array([fingerprint for _, fingerprint in months], \
+                                             dtype=str))
+    os.replace(path + '.tmp', path)
+
+
+@profiled('load_state')
+def load_state(path=STATE_PATH, sentinels=NA_SENTINELS, station_index=None):
+    """function to load the partial aggregates, seen ride_ids, and months saved by save_state"""
+    with np.load(path, allow_pickle=False) as state:
+        if state['trips'].shape != CUBE_SHAPE:
+            raise ValueError(f"{path} was saved with different CUBE_AXES, please rebuild it "
+                             "from all the csv files")
+        if 'flow_shape' not in state.files or tuple(state['flow_shape']) != FLOW_SHAPE:
+            raise ValueError(f"{path} was saved with different (or without) FLOW_AXES, please "
+                             "rebuild it from all the csv files")
+        if 'point_shape' not in state.files or tuple(state['point_shape']) != POINT_SHAPE \
+                or tuple(state['point_grid']) != POINT_ORIGIN + POINT_STEP:
+            raise ValueError(f"{path} was saved with a different (or without a) point grid, "
+                             "please rebuild it from all the csv files")
+        if state['station_counts'].shape[1] != len(STATION_COUNT_COLUMNS):
+            raise ValueError(f"{path} was saved with different STATION_COUNT_COLUMNS, please "
+                             "rebuild it from all the csv files")
+        if 'ride_ids' not in state.files:
+            raise ValueError(f"{path} was saved without the counted ride_ids, please rebuild "
+                             "it from all the csv files")
+        # New months have to be read with the same NA sentinels as the counted ones
+        if 'na_sentinels' not in state.files \
+                or state['na_sentinels'].tolist() != normalize_sentinels(sentinels):
+            raise ValueError(f"{path} was saved with different (or without) NA sentinels, "
+                             "please use the same ones or rebuild it from all the csv files")
+        # ... and matched to the stations the same way
+        if 'station_radius' not in state.files \
+                or float(state['station_radius']) != state_station_radius(station_index):
+            raise ValueError(f"{path} was saved with a different (or without a) station radius, "
+                             "please use the same one or rebuild it from all the csv files")
+
+        counts = {
+            'trips': state['trips'],
+            'ride_length': state['ride_length'],
+            'stations': pd.DataFrame(state['station_counts'], columns=STATION_COUNT_COLUMNS, \
+                                     index=pd.Index(state['station_names'].tolist(), \
+                                                    dtype=object)),
+            'flows': {
+                'stations': state['flow_stations'].astype(object),
+                'keys': state['flow_keys'],
+                'counts': state['flow_counts'],
+            },
+            'points': dense_points(state['point_cells'], state['point_counts']),
+        }
+        months = list(zip(state['month_files'].tolist(), state['month_fingerprints'].tolist()))
+        seen = seen_ride_ids(state['ride_ids'])
+
+    return counts, months, seen
+
+
+def state_station_radius(station_index=None):
+    """function to get the station radius a state is counted with, 0 for station names only"""
+    return 0.0 if station_index is None else float(station_index['radius'])
+
+
+def month_fingerprints(paths):
+    """function to list the (file name, fingerprint) of every csv file"""
+    return [(os.path.basename(path), file_fingerprint(path)) for path in paths]
+
+
+def counted_months(counts):
+    """function to list the months (1 to 12) with trips in the partial aggregates"""
+    month_axis = list(CUBE_AXES).index('month')
+    trips = counts['trips'].sum(axis=tuple(axis for axis in range(len(CUBE_SHAPE)) \
+                                           if axis != month_axis))
+
+    return CUBE_AXES['month'][trips > 0]
+
+
+def append_months(paths, state_path=STATE_PATH, streaming=False, chunksize=CHUNK_SIZE,
+                  cache_dir=None, workers=1, station_index=None, backend='pandas',
+                  memory_limit=None, sentinels=NA_SENTINELS):
+    """function to fold new monthly csv files into the saved state, without a full rebuild"""
+    counts, months, seen = load_state(state_path, sentinels, station_index)
+    known_months = dict(months)
+
+    new_paths = []
+    for path, (name, fingerprint) in zip(paths, month_fingerprints(paths)):
+        if known_months.get(name) == fingerprint:
+            print(f"{name} is already counted, skipping it")
+            continue
+
+        # The state only has the merged counts, so a changed month can't be taken out again
+        if name in known_months:
+            raise ValueError(f"{name} changed since it was counted, please rebuild the state "
+                             "from all the csv files")
+
+        new_paths.append(path)
+        months.append((name, fingerprint))
+        known_months[name] = fingerprint
+
+    # Every new month is counted on its own (with all the workers or DuckDB threads), so
+    #  it can be checked before it is merged into the state
+    if backend == 'duckdb':
+        month_counts = ((path, count_files_duckdb([path], station_index, \
+                                                  threads=workers if workers > 1 else None, \
+                                                  memory_limit=memory_limit, \
+                                                  batch_size=chunksize, seen=seen, \
+                                                  sentinels=sentinels)) for path in new_paths)
+    else:
+        month_counts = iter_month_counts(new_paths, chunksize if streaming else None, \
+                                         cache_dir, workers, station_index, seen, sentinels)
+
+    for path, partial in month_counts:
+        # The trip cube has no year axis, so e.g. January 2023 would be added to the
+        #  January 2022 trips of the state. A new month has to be a month without trips
+        #  in the state yet, the months of several years only go together in a full rebuild
+        overlap = np.intersect1d(counted_months(counts), counted_months(partial))
+        if len(overlap) > 0:
+            raise ValueError(f"{os.path.basename(path)} has trips in month(s) "
+                             f"{', '.join(str(month) for month in overlap)}, which the state "
+                             "already has from other csv files. The trip cube has no year "
+                             "axis, please rebuild the state from all the csv files instead")
+
+        counts = merge_counts(counts, partial)
+
+    save_state(counts, months, seen, state_path, sentinels, station_index)
+
+    return counts, months
+
+
+# %%
+## Artifacts - the handoff to app.py. Every array is a .npy file and every table an Arrow
+#  IPC file, so app.py can memory-map them read-only (several app processes share one copy
+#  of the pages) and they don't depend on the pandas version. manifest.json lists them all,
+#  with the format version and the csv files they came from
+def replace_file(path, write):
+    """function to write a file under a temporary name first, and then move it into place"""
+    # app.py may have the old file memory-mapped, so it must be replaced, never overwritten
+    with open(path + '.tmp', 'wb') as new_file:
+        write(new_file)
+    os.replace(path + '.tmp', path)
+
+
+def write_arrays(directory, name, arrays, axes):
+    """function to write a bundle of arrays as .npy files, and return its manifest entry"""
+    os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    entry = {'arrays': {}, 'axes': {axis: np.asarray(labels).tolist() \
+                                    for axis, labels in axes.items()}}
+    for key, values in arrays.items():
+        array_file = f"{name}/{key}.npy"
+        replace_file(os.path.join(directory, array_file), \
+                     lambda new_file, values=values: np.save(new_file, values, allow_pickle=False))
+        entry['arrays'][key] = {'file': array_file, 'dtype': values.dtype.str, \
+                                'shape': list(values.shape)}
+
+    return entry
+
+
+def write_table(directory, name, table):
+    """function to write a dataframe as an Arrow IPC file, and return its manifest entry"""
+    table_file = f"{name}.arrow"
+    arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+
+    def write(new_file):
+        with pa.ipc.new_file(new_file, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+
+    replace_file(os.path.join(directory, table_file), write)
+
+    return {'table': table_file, 'columns': {column: str(dtype) \
+                                             for column, dtype in table.dtypes.items()}}
+
+
+def flow_arrays(flows):
+    """function to turn the trip flows into the arrays that app.py reads"""
+    buckets, start_codes, end_codes = split_flow_keys(flows)
+
+    # The station maps need the trips that start or end at every station, and the trips
+    #  that start there (see STATION_COUNT_COLUMNS), for any selection of buckets. Dense
+    #  station x bucket tables (a few MB each) are much faster to sum than the flows, see
+    #  flow_station_counts
+    bucket_count = np.prod(FLOW_SHAPE)
+    station_trips = np.bincount(np.concatenate([start_codes, end_codes]) * bucket_count \
+                                    + np.tile(buckets, 2), \
+                                weights=np.tile(flows['counts'], 2), \
+                                minlength=len(flows['stations']) * bucket_count)
+    station_starts = np.bincount(start_codes * bucket_count + buckets, weights=flows['counts'], \
+                                 minlength=len(flows['stations']) * bucket_count)
+
+    # The flows are sorted by bucket, so the flows of bucket b are the rows from
+    #  bucket_start[b] to bucket_start[b + 1]. The buckets are the FLOW_AXES combinations,
+    #  in order (member_casual first, hour last)
+    return {
+        'stations': np.array(flows['stations'], dtype=str),
+        'bucket_start': np.searchsorted(buckets, np.arange(bucket_count + 1)),
+        'start_station': start_codes.astype(np.int32),
+        'end_station': end_codes.astype(np.int32),
+        'count': flows['counts'],
+        'station_trips': station_trips.astype(np.int32).reshape(-1, *FLOW_SHAPE),
+        'station_starts': station_starts.astype(np.int32).reshape(-1, *FLOW_SHAPE),
+    }
+
+
+def point_levels(points):
+    """function to build every level of the point grid, from the finest to the coarsest"""
+    levels = [points]
+    for _ in range(1, POINT_LEVELS):
+        # Every cell of the next level adds up 2 x 2 cells of this one
+        rows, columns = levels[-1].shape[-2:]
+        levels.append(levels[-1].reshape(*levels[-1].shape[:-2], rows // 2, 2, columns // 2, 2) \
+                                .sum(axis=(-3, -1)))
+
+    return {f'level_{level}': grid.astype(np.int32) for level, grid in enumerate(levels)}
+
+
+@profiled('write_artifacts')
+def write_artifacts(counts, tables, months, directory=ARTIFACTS_DIR):
+    """function to write the trip cube, flows, and points, and the tables for app.py"""
+    os.makedirs(directory, exist_ok=True)
+
+    # The whole trip cube is only a few hundred KB, every chart of app.py is a sum over
+    #  some of its axes (see build_trip_tables)
+    artifacts = {
+        'trip_cube': write_arrays(directory, 'trip_cube', {'trips': counts['trips'], \
+                                  'ride_length': counts['ride_length']}, CUBE_AXES),
+        'trip_flows': write_arrays(directory, 'trip_flows', flow_arrays(counts['flows']), \
+                                   FLOW_AXES),
+        # The origin and cell size of the grid go with the axes, so app.py puts the cells
+        #  exactly where they were counted
+        'trip_points': write_arrays(directory, 'trip_points', point_levels(counts['points']), \
+                                    {'member_casual': MEMBER_TYPES, 'end': POINT_ENDS, \
+                                     'origin': POINT_ORIGIN, 'step': POINT_STEP}),
+    }
+    for name, table in tables.items():
+        artifacts[name] = write_table(directory, name, table)
+
+    manifest = {
+        'format_version': ARTIFACT_FORMAT_VERSION,
+        'sources': [{'file': name, 'fingerprint': fingerprint} for name, fingerprint in months],
+        'artifacts': artifacts,
+    }
+
+    # The manifest is written last, app.py uses its modification time to notice new artifacts
+    replace_file(os.path.join(directory, MANIFEST_FILE), \
+                 lambda new_file: new_file.write(json.dumps(manifest, indent=2).encode()))
+
+
+def read_manifest(directory=ARTIFACTS_DIR):
+    """function to read the manifest of the artifacts, if this version of divvy.py can read them"""
+    with open(os.path.join(directory, MANIFEST_FILE), encoding='utf-8') as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if manifest.get('format_version') != ARTIFACT_FORMAT_VERSION:
+        raise ValueError(f"{directory} has artifact format version "
+                         f"{manifest.get('format_version')}, but this divvy.py reads version "
+                         f"{ARTIFACT_FORMAT_VERSION}, please run divvy.py again")
 
-## Export Dataframes to Pickles, so we can use them with app.py
-day_of_week_count.to_pickle('day_of_week_count.pkl')
-popular_month_count_member.to_pickle('popular_month_count_member.pkl')
-popular_month_count_casual.to_pickle('popular_month_count_casual.pkl')
-popular_hours_count.to_pickle('popular_hours_count.pkl')
-ride_length_avg.to_pickle('ride_length_avg.pkl')
-rideable_type_count_member.to_pickle('rideable_type_count_member.pkl')
-rideable_type_count_casual.to_pickle('rideable_type_count_casual.pkl')
-station_name_count_member_w_location.to_pickle('station_name_count_member_w_location.pkl')
-station_name_count_casual_w_location.to_pickle('station_name_count_casual_w_location.pkl')
+    return manifest
+
+
+def has_artifact(name, manifest, directory=ARTIFACTS_DIR):
+    """function to check that an artifact is in the manifest and all of its files exist"""
+    entry = manifest['artifacts'].get(name)
+    if entry is None:
+        return False
+
+    files = [array['file'] for array in entry['arrays'].values()] if 'arrays' in entry \
+                else [entry['table']]
+
+    return all(os.path.exists(os.path.join(directory, name_file)) for name_file in files)
+
+
+def load_arrays(name, manifest, directory=ARTIFACTS_DIR):
+    """function to memory-map (read-only) a bundle of arrays, together with its axis labels"""
+    entry = manifest['artifacts'][name]
+
+    arrays = {}
+    for key, array in entry['arrays'].items():
+        arrays[key] = np.load(os.path.join(directory, array['file']), mmap_mode='r', \
+                              allow_pickle=False)
+
+        if arrays[key].dtype.str != array['dtype'] or list(arrays[key].shape) != array['shape']:
+            raise ValueError(f"{array['file']} doesn't match {MANIFEST_FILE}, please run "
+                             "divvy.py again")
+
+    arrays.update({axis: np.asarray(labels) for axis, labels in entry['axes'].items()})
+
+    return arrays
+
+
+def load_table(name, manifest, directory=ARTIFACTS_DIR):
+    """function to load a table from its (memory-mapped) Arrow IPC file"""
+    with pa.memory_map(os.path.join(directory, manifest['artifacts'][name]['table'])) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def load_cube(manifest, directory=ARTIFACTS_DIR):
+    """function to memory-map the trip cube saved by write_artifacts"""
+    cube = load_arrays('trip_cube', manifest, directory)
+
+    if any(cube[axis].tolist() != np.asarray(labels).tolist() \
+           for axis, labels in CUBE_AXES.items()):
+        raise ValueError(f"{directory} was saved with different CUBE_AXES, please run "
+                         "divvy.py again")
+
+    return {'trips': cube['trips'], 'ride_length': cube['ride_length']}
+
+
+def select_flows(flows, **selection):
+    """function to get a boolean array of the exported trip flows in the selected buckets"""
+    # The flows of every bucket are next to each other (see flow_arrays), so let's pick
+    #  the buckets first and then repeat that for the rows of every bucket
+    selected = select_labels({axis: flows[axis] for axis in FLOW_AXES}, **selection)
+
+    return np.repeat(selected.ravel(), np.diff(flows['bucket_start']))
+
+
+def flow_station_counts(flows, **selection):
+    """function to count the trips that start or end at every station, for the selected buckets"""
+    # Same as count_stations, but only for the trips in the selected buckets. Let's sum
+    #  station_trips and station_starts over the selected buckets of every member_casual type
+    selected = select_labels({axis: flows[axis] for axis in FLOW_AXES}, **selection) \
+                   .reshape(len(MEMBER_TYPES), -1)
+    counts = [np.einsum('smb,mb->sm', flows[key].reshape(len(flows['stations']), \
+                                                         len(MEMBER_TYPES), -1), \
+                        selected, dtype=np.int64) for key in ('station_trips', 'station_starts')]
+
+    station_counts = pd.DataFrame(np.hstack(counts), columns=STATION_COUNT_COLUMNS, \
+                                  index=pd.Index(flows['stations'].tolist(), dtype=object))
+
+    return station_counts[station_counts.sum(axis=1) > 0]
+
+
+def point_cell_counts(points, level=0, **selection):
+    """function to list the cells of a point grid level with trips, for the selected labels"""
+    # Let's add up the selected member_casual types and ends (start and/or end points)
+    selected = select_labels({axis: points[axis] for axis in ('member_casual', 'end')}, \
+                             **selection)
+    grid = np.einsum('me,mers->rs', selected, points[f'level_{level}'], dtype=np.int64)
+
+    # Every cell is placed at its south-west corner
+    rows, columns = np.nonzero(grid)
+    cell_size = 2 ** level
+
+    return pd.DataFrame({
+        'Latitude': points['origin'][0] + rows * cell_size * points['step'][0],
+        'Longitude': points['origin'][1] + columns * cell_size * points['step'][1],
+        'count': grid[rows, columns],
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('paths', nargs='*', default=MONTH_FILES,
+                        help="monthly divvy_tripdata csv files (default: all of 2022)")
+    parser.add_argument('--streaming', action='store_true',
+                        help="read, clean and count the csv files chunk by chunk")
+    parser.add_argument('--chunksize', type=int, default=CHUNK_SIZE,
+                        help="rows per chunk in streaming mode")
+    parser.add_argument('--cache', nargs='?', const=CACHE_DIR, default=None, metavar='DIR',
+                        help=f"cache the cleaned months as Parquet files (default: {CACHE_DIR})")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes, each one counts a different month")
+    parser.add_argument('--sort', choices=SORT_MODES, default='month',
+                        help="how to sort the trips by started_at in the default (eager) mode: "
+                             "the whole year, month by month (same order, skips months that "
+                             "are already sorted), or not at all (fastest, the outputs are "
+                             "only counts)")
+    parser.add_argument('--state', default=STATE_PATH,
+                        help=f"where the partial aggregates are saved (default: {STATE_PATH})")
+    parser.add_argument('--append', action='store_true',
+                        help="fold the given csv files into the saved state instead of "
+                             "counting everything again")
+    parser.add_argument('--artifacts', default=ARTIFACTS_DIR,
+                        help="where the artifacts for app.py are written "
+                             f"(default: {ARTIFACTS_DIR})")
+    parser.add_argument('--station-radius', type=float, default=STATION_RADIUS,
+                        help="match trips to the nearest station within this many meters, "
+                             "0 to match by station name only")
+    parser.add_argument('--backend', choices=BACKENDS, default='pandas',
+                        help="engine that reads, cleans and counts the csv files, duckdb runs "
+                             "out of core (needs pip install duckdb)")
+    parser.add_argument('--memory-limit', default=None,
+                        help="memory limit of the duckdb backend, e.g. 4GB (it spills to "
+                             f"{DUCKDB_TEMP_DIR} beyond that)")
+    parser.add_argument('--na-sentinels', nargs='+', default=NA_SENTINELS, metavar='VALUE',
+                        help="strings (in any case) that are read as empty values "
+                             f"(default: {' '.join(NA_SENTINELS)})")
+    parser.add_argument('--profile', nargs='?', const=PROFILE_PATH, default=None, metavar='PATH',
+                        help="write the wall time and rows of every stage as JSON, '-' for "
+                             f"the screen (default: {PROFILE_PATH})")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="profile the peak memory of every stage too (with tracemalloc, "
+                             "which slows some stages down a lot)")
+    args = parser.parse_args()
+
+    if args.profile_memory and not args.profile:
+        args.profile = PROFILE_PATH
+    if args.profile:
+        start_profile(memory=args.profile_memory)
+
+    divvy_bicycle_stations = read_bicycle_stations()
+    divvy_station_index = build_station_index(divvy_bicycle_stations, args.station_radius) \
+                                if args.station_radius > 0 else None
+
+    if args.append:
+        divvy_counts, divvy_months = append_months(args.paths, args.state,
+                                        streaming=args.streaming, chunksize=args.chunksize,
+                                        cache_dir=args.cache, workers=args.workers,
+                                        station_index=divvy_station_index, backend=args.backend,
+                                        memory_limit=args.memory_limit,
+                                        sentinels=args.na_sentinels)
+    else:
+        divvy_seen = seen_ride_ids()
+        divvy_counts = count_files(args.paths, streaming=args.streaming, chunksize=args.chunksize,
+                                   cache_dir=args.cache, workers=args.workers, sort=args.sort,
+                                   station_index=divvy_station_index, backend=args.backend,
+                                   memory_limit=args.memory_limit, seen=divvy_seen,
+                                   sentinels=args.na_sentinels)
+        divvy_months = month_fingerprints(args.paths)
+        save_state(divvy_counts, divvy_months, divvy_seen, args.state, args.na_sentinels,
+                   divvy_station_index)
+
+    write_artifacts(divvy_counts, build_outputs(divvy_counts, divvy_bicycle_stations), \
+                    divvy_months, args.artifacts)
+
+    if args.profile:
+        write_profile(stop_profile(), args.profile)